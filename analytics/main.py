@@ -4,19 +4,27 @@ import sys
 import time
 import cv2
 import socket
+import struct
+import hashlib
 import base64
+import json
 import logging
 import traceback
 import numpy as np
 import asyncio
+import threading
+import subprocess
 import requests
 import torch
-from fastapi import FastAPI, WebSocket, Response, HTTPException
+from fastapi import FastAPI, WebSocket, Request, Response, HTTPException
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.websockets import WebSocketDisconnect
 import uvicorn
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 from pathlib import Path
+from collections import deque, OrderedDict
+from datetime import datetime
 from deep_sort_realtime.deepsort_tracker import DeepSort
 from concurrent.futures import ThreadPoolExecutor
 main_event_loop = None
@@ -67,6 +75,53 @@ JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "50")) # Качество для We
 IMG_SIZE_W = int(os.getenv("IMG_SIZE_W", "320"))
 IMG_SIZE_H = int(os.getenv("IMG_SIZE_H", "320"))
 img_size = (IMG_SIZE_H, IMG_SIZE_W)
+DEFAULT_CAMERA_ID = "camera_udp_0"
+
+# Необязательный заголовок кадра (добавляют диспетчер и генераторы нагрузки):
+# magic, номер кадра, время захвата (unix, сек), длина id камеры; далее id камеры и JPEG
+FRAME_HEADER_MAGIC = b"VSF1"
+FRAME_HEADER = struct.Struct(">4sIdB")
+
+# Уровни качества WebSocket-потока: от лучшего к худшему. width=0 — исходное разрешение
+WS_TIERS = json.loads(os.getenv("WS_TIERS", json.dumps({
+    "high": {"width": 0, "quality": JPEG_QUALITY, "fps": 50},
+    "medium": {"width": 640, "quality": 45, "fps": 15},
+    "low": {"width": 320, "quality": 35, "fps": 5},
+})))
+WS_TIER_ORDER = list(WS_TIERS)
+WS_DEFAULT_TIER = os.getenv("WS_DEFAULT_TIER", WS_TIER_ORDER[0])
+WS_SLOW_SENDS_TO_DOWNGRADE = int(os.getenv("WS_SLOW_SENDS_TO_DOWNGRADE", "3"))
+TRACKER_IDLE_SECONDS = float(os.getenv("TRACKER_IDLE_SECONDS", "60"))  # Трекер камеры без кадров удаляется
+PROCESSED_LOG_SIZE = int(os.getenv("PROCESSED_LOG_SIZE", "10000"))  # Журнал обработанных кадров для генератора нагрузки
+INFERENCE_THREAD_PREFIX = "inference"  # Имена потоков-обработчиков (по ним фильтрует профайлер)
+
+# Сброс нагрузки: лестница режимов «модель@размер[/пропуск кадров]» от лучшего к самому легкому,
+# например "yolov5s.pt@416,yolov5s.pt@320,yolov5n.pt@320,yolov5n.pt@320/2". Пусто — один режим из MODEL_PATH/IMG_SIZE
+LOAD_LADDER = os.getenv("LOAD_LADDER", "")
+LOAD_LATENCY_HIGH_MS = float(os.getenv("LOAD_LATENCY_HIGH_MS", "250"))
+LOAD_LATENCY_LOW_MS = float(os.getenv("LOAD_LATENCY_LOW_MS", "100"))
+LOAD_CHECK_INTERVAL = float(os.getenv("LOAD_CHECK_INTERVAL", "1.0"))
+LOAD_STEP_DOWN_HOLD = float(os.getenv("LOAD_STEP_DOWN_HOLD", "3"))  # Сек перегрузки до понижения режима
+LOAD_STEP_UP_HOLD = float(os.getenv("LOAD_STEP_UP_HOLD", "15"))  # Сек запаса до повышения режима
+
+# Снимки треков: лучший по уверенности кроп отправляется в API только при улучшении
+SNAPSHOTS_ENABLED = os.getenv("SNAPSHOTS_ENABLED", "true").lower() == "true"
+SNAPSHOT_JPEG_QUALITY = int(os.getenv("SNAPSHOT_JPEG_QUALITY", "85"))
+SNAPSHOT_MIN_IMPROVEMENT = float(os.getenv("SNAPSHOT_MIN_IMPROVEMENT", "0.05"))
+SNAPSHOT_PADDING = float(os.getenv("SNAPSHOT_PADDING", "0.1"))  # Поля вокруг рамки, доля от размера
+
+# Запись клипов по событиям (кольцевой буфер JPEG-датаграмм на камеру)
+CLIP_RECORDING_ENABLED = os.getenv("CLIP_RECORDING_ENABLED", "true").lower() == "true"
+CLIP_PRE_SECONDS = float(os.getenv("CLIP_PRE_SECONDS", "5"))
+CLIP_POST_SECONDS = float(os.getenv("CLIP_POST_SECONDS", "5"))
+CLIP_MAX_SECONDS = float(os.getenv("CLIP_MAX_SECONDS", "60"))  # Предел длины клипа при слиянии событий
+CLIP_FORMAT = os.getenv("CLIP_FORMAT", "mjpeg").lower()  # mjpeg | mp4
+FRAME_RING_SECONDS = float(os.getenv("FRAME_RING_SECONDS", str(CLIP_PRE_SECONDS)))
+FRAME_RING_MAX_BYTES = int(os.getenv("FRAME_RING_MAX_BYTES", str(32 * 1024 * 1024)))  # На одну камеру
+CLIP_MAX_BYTES = int(os.getenv("CLIP_MAX_BYTES", str(256 * 1024 * 1024)))  # Предел объема одного клипа в памяти
+JPEG_SOI = b"\xff\xd8"  # В кольцевой буфер попадают только датаграммы, начинающиеся с маркера JPEG
+CLIP_RETENTION_MAX_BYTES = int(os.getenv("CLIP_RETENTION_MAX_BYTES", str(10 * 1024 ** 3)))  # Объем CLIP_DIR
+CLIP_RETENTION_SECONDS = float(os.getenv("CLIP_RETENTION_SECONDS", str(7 * 24 * 3600)))  # 0 — без предела по возрасту
 
 # Определение путей к моделям
 if os.path.exists('/app'): # Внутри Docker
@@ -77,6 +132,15 @@ else: # Локально
     model_path = os.getenv("MODEL_PATH", "yolov5s.pt")
     # --- ИЗМЕНЕНИЕ ЗДЕСЬ ---
     deep_sort_model_path = os.getenv("DEEPSORT_MODEL_PATH", "deep_sort_weights/mars-small128.pb")
+CLIP_DIR = os.getenv("CLIP_DIR", "/app/clips" if os.path.exists('/app') else "clips")
+# Локальные пути считаются от каталога сервиса, а не от текущего каталога запуска
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+EXECUTION_PLAN_PATH = os.getenv("EXECUTION_PLAN_PATH",
+                                "/app/config/execution_plan.json" if os.path.exists('/app')
+                                else os.path.join(SERVICE_DIR, "execution_plan.json"))
+BENCHMARK_VIDEO = os.getenv("BENCHMARK_VIDEO",
+                            "/app/test_video.mp4" if os.path.exists('/app/test_video.mp4')
+                            else os.path.join(SERVICE_DIR, "..", "test_video.mp4"))
 
 
 # Проверка наличия файла YOLOv5
@@ -107,6 +171,127 @@ except Exception as e:
     device = torch.device("cpu")
 
 
+# --- План выполнения: потоки torch/OpenCV, число обработчиков и привязка к ядрам ---
+def parse_cpu_list(spec):
+    """Разбор списка ядер вида '0-7,16-23'"""
+    cores = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cores.extend(range(int(start), int(end) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def load_execution_plan():
+    """
+    План берется из EXECUTION_PLAN_PATH (его записывает --autotune), переменные
+    окружения имеют приоритет. Без плана поведение прежнее: по обработчику на ядро,
+    потоки torch по умолчанию.
+    """
+    try:
+        available_cores = sorted(os.sched_getaffinity(0))
+    except AttributeError:  # Не Linux
+        available_cores = list(range(os.cpu_count() or 4))
+
+    plan = {}
+    if os.path.exists(EXECUTION_PLAN_PATH):
+        try:
+            with open(EXECUTION_PLAN_PATH) as f:
+                plan = json.load(f)
+            logger.info(f"Загружен план выполнения из {EXECUTION_PLAN_PATH}: {plan}")
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось прочитать план выполнения {EXECUTION_PLAN_PATH}: {e}")
+
+    def setting(env_name, key, default):
+        value = os.getenv(env_name)
+        if value is not None:
+            return value
+        return plan.get(key, default)
+
+    cpu_spec = setting("CPU_AFFINITY", "cpu_affinity", "")
+    if isinstance(cpu_spec, list):
+        cores = [int(c) for c in cpu_spec]
+    else:
+        cores = parse_cpu_list(cpu_spec) if cpu_spec else available_cores
+    return {
+        "inference_workers": int(setting("INFERENCE_WORKERS", "inference_workers", len(cores) or 4)),
+        "torch_intra_op_threads": int(setting("TORCH_INTRA_OP_THREADS", "torch_intra_op_threads", 0)),
+        "torch_inter_op_threads": int(setting("TORCH_INTER_OP_THREADS", "torch_inter_op_threads", 0)),
+        "opencv_threads": int(setting("OPENCV_THREADS", "opencv_threads", -1)),
+        "cpu_affinity": cores,
+        "pin_process": bool(cpu_spec),  # Процесс ограничивается ядрами только при явном списке
+        "pin_workers": str(setting("PIN_WORKERS", "pin_workers", False)).lower() == "true",
+    }
+
+
+execution_plan = load_execution_plan()
+# Лимит кадров в обработке (выполняемые + ожидающие): не меньше числа обработчиков, иначе часть простаивает
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", str(max(10, 2 * execution_plan["inference_workers"]))))
+# Пороги сброса нагрузки по числу ожидающих (еще не начатых) кадров — доли свободного места очереди
+_queue_wait_capacity = max(MAX_QUEUE_SIZE - execution_plan["inference_workers"], 1)
+LOAD_QUEUE_HIGH = int(os.getenv("LOAD_QUEUE_HIGH", str(max(1, _queue_wait_capacity * 3 // 4))))
+LOAD_QUEUE_LOW = int(os.getenv("LOAD_QUEUE_LOW", str(_queue_wait_capacity // 4)))
+
+
+def apply_execution_plan(plan):
+    """Применяется до загрузки модели: число inter-op потоков torch можно задать только один раз"""
+    if plan["opencv_threads"] >= 0:
+        cv2.setNumThreads(plan["opencv_threads"])
+    if plan["torch_intra_op_threads"] > 0:
+        torch.set_num_threads(plan["torch_intra_op_threads"])
+    if plan["torch_inter_op_threads"] > 0:
+        try:
+            torch.set_num_interop_threads(plan["torch_inter_op_threads"])
+        except RuntimeError as e:
+            logger.warning(f"Не удалось задать число inter-op потоков torch: {e}")
+    if plan["pin_process"] and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, plan["cpu_affinity"])
+        except (AttributeError, OSError) as e:
+            logger.warning(f"Не удалось задать привязку процесса к ядрам: {e}")
+    logger.info(
+        f"План выполнения: обработчиков {plan['inference_workers']}, "
+        f"torch intra/inter {torch.get_num_threads()}/{torch.get_num_interop_threads()}, "
+        f"OpenCV {cv2.getNumThreads()}, ядра {plan['cpu_affinity']}, привязка обработчиков {plan['pin_workers']}")
+
+
+_worker_slot_counter = 0
+_worker_slot_lock = Lock()
+
+
+def init_inference_worker():
+    """
+    Инициализатор потока-обработчика: при PIN_WORKERS каждый поток получает
+    свой непересекающийся набор ядер размером torch_intra_op_threads.
+    """
+    global _worker_slot_counter
+    plan = execution_plan
+    if plan["torch_intra_op_threads"] > 0:
+        torch.set_num_threads(plan["torch_intra_op_threads"])
+    if not plan["pin_workers"] or not hasattr(os, "sched_setaffinity"):
+        return
+    with _worker_slot_lock:
+        slot = _worker_slot_counter
+        _worker_slot_counter += 1
+    cores = plan["cpu_affinity"]
+    per_worker = max(1, plan["torch_intra_op_threads"] or len(cores) // max(plan["inference_workers"], 1))
+    start = (slot * per_worker) % len(cores)
+    worker_cores = [cores[(start + i) % len(cores)] for i in range(per_worker)]
+    try:
+        os.sched_setaffinity(threading.get_native_id(), worker_cores)
+        logger.info(f"Обработчик {slot} привязан к ядрам {worker_cores}")
+    except OSError as e:
+        logger.warning(f"Не удалось привязать обработчик {slot} к ядрам {worker_cores}: {e}")
+
+
+apply_execution_plan(execution_plan)
+
+
 # Определение функции scale_boxes (версия, избегающая inplace)
 def scale_boxes(img1_shape, boxes, img0_shape):
     """
@@ -148,9 +333,16 @@ async def on_startup():
 
 # Глобальные переменные
 latest_processed_frame = None
-connected_websockets = set()
+latest_frames = {}  # camera_id -> (версия кадра, кадр, время обработки, время захвата)
+latest_frame_times = (None, None)  # (время обработки, время захвата) последнего кадра любой камеры
+frame_version = 0
+processed_log = deque(maxlen=PROCESSED_LOG_SIZE)  # Кадры с заголовком: (id записи, камера, seq, время захвата, время обработки)
+processed_log_id = 0
+connected_websockets = {}  # websocket -> текущий уровень качества
 frame_lock = Lock()
-executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+executor = ThreadPoolExecutor(max_workers=execution_plan["inference_workers"], initializer=init_inference_worker,
+                              thread_name_prefix=INFERENCE_THREAD_PREFIX)
+alerts_enabled = True  # Отключается в режиме --benchmark
 
 # Загрузка модели YOLOv5
 try:
@@ -163,13 +355,153 @@ except Exception as e:
     logger.error(f"Ошибка загрузки модели YOLOv5: {e}", exc_info=True)
     sys.exit(1)
 
-# Инициализация DeepSort
-try:
-    # --- ИЗМЕНЕНИЕ ЗДЕСЬ: Параметры для mars-small128.pb ---
-  #  logger.info(f"Инициализация DeepSort с TensorFlow моделью '{deep_sort_model_path}'")
-    from deep_sort_realtime.deepsort_tracker import DeepSort
 
-    tracker = DeepSort(
+# --- Сброс нагрузки: лестница режимов работы ---
+class OperatingPoint:
+    def __init__(self, name, model, model_stride, size, frame_skip):
+        self.name = name
+        self.model = model
+        self.stride = model_stride
+        self.img_size = size
+        self.frame_skip = frame_skip
+
+
+def parse_load_ladder(spec):
+    """'yolov5s.pt@416,yolov5n.pt@320x256/2' -> [(путь, (h, w), пропуск), ...]"""
+    levels = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        path, _, rest = item.partition("@")
+        size_spec, _, skip_spec = rest.partition("/")
+        if "x" in size_spec:
+            w, h = size_spec.split("x")
+            size = (int(h), int(w))
+        elif size_spec:
+            size = (int(size_spec), int(size_spec))
+        else:
+            size = img_size
+        levels.append((path or model_path, size, int(skip_spec) if skip_spec else 1))
+    return levels
+
+
+def build_operating_points():
+    """Все модели лестницы загружаются заранее, чтобы переключение было мгновенным"""
+    levels = parse_load_ladder(LOAD_LADDER) or [(model_path, img_size, max(PROCESS_EVERY_N_FRAMES, 1))]
+    loaded = {model_path: (model, stride)}
+    points = []
+    for path, size, frame_skip in levels:
+        if path not in loaded:
+            if not os.path.exists(path):
+                logger.error(f"Файл модели для лестницы режимов не найден: {path}")
+                sys.exit(1)
+            logger.info(f"Предзагрузка модели {path} для лестницы режимов")
+            extra_model = DetectMultiBackend(path, device=device, dnn=False, fp16=(device.type != 'cpu'))
+            extra_model.eval()
+            loaded[path] = (extra_model, int(extra_model.stride) if hasattr(extra_model, 'stride') else 32)
+        level_model, level_stride = loaded[path]
+        try:
+            level_model.warmup(imgsz=(1, 3, *size))
+        except Exception as e:
+            logger.debug(f"Прогрев модели {path}@{size} не выполнен: {e}")
+        name = f"{os.path.basename(path)}@{size[1]}x{size[0]}" + (f"/{frame_skip}" if frame_skip > 1 else "")
+        points.append(OperatingPoint(name, level_model, level_stride, size, frame_skip))
+    return points
+
+
+class LoadController:
+    """
+    Следит за задержкой обработки (EMA от приема до публикации кадра) и глубиной
+    очереди и переключает режимы лестницы: вниз при устойчивой перегрузке, вверх при
+    устойчивом запасе. Переключение — замена ссылки на режим: кадры, уже взятые
+    в обработку, дорабатываются в прежнем режиме, кадры не теряются.
+    Глубина очереди — счетчик кадров, отправленных в пул и еще не начатых обработчиком;
+    его ведут frame_queued/frame_started, так что контур видит очередь и при затихшем UDP.
+    """
+    def __init__(self, points):
+        self.points = points
+        self.level = 0
+        self.current = points[0]
+        self.lock = Lock()
+        self.latency_ema_ms = None
+        self.queue_depth = 0
+        self.enabled = True  # Выключается в режиме --benchmark: замер идет в одном режиме
+        self.overload_since = None
+        self.headroom_since = None
+        self.switches = 0
+        if len(points) > 1:
+            Thread(target=self._control_loop, daemon=True).start()
+
+    def observe(self, latency_seconds):
+        value = latency_seconds * 1000.0
+        with self.lock:
+            if self.latency_ema_ms is None:
+                self.latency_ema_ms = value
+            else:
+                self.latency_ema_ms = 0.8 * self.latency_ema_ms + 0.2 * value
+
+    def frame_queued(self):
+        with self.lock:
+            self.queue_depth += 1
+
+    def frame_started(self):
+        with self.lock:
+            self.queue_depth -= 1
+
+    def _set_level(self, level, reason):
+        previous = self.current.name
+        with self.lock:
+            self.level = level
+            self.current = self.points[level]
+            self.latency_ema_ms = None
+            self.overload_since = None
+            self.headroom_since = None
+            self.switches += 1
+        logger.warning(f"Режим обработки: {previous} -> {self.current.name} ({reason})")
+
+    def _control_loop(self):
+        while True:
+            time.sleep(LOAD_CHECK_INTERVAL)
+            if not self.enabled:
+                continue
+            now = time.time()
+            with self.lock:
+                latency = self.latency_ema_ms
+                queue_depth = self.queue_depth
+            overloaded = queue_depth >= LOAD_QUEUE_HIGH or (latency is not None and latency > LOAD_LATENCY_HIGH_MS)
+            has_headroom = queue_depth <= LOAD_QUEUE_LOW and latency is not None and latency < LOAD_LATENCY_LOW_MS
+
+            if overloaded:
+                self.headroom_since = None
+                self.overload_since = self.overload_since or now
+                if now - self.overload_since >= LOAD_STEP_DOWN_HOLD and self.level + 1 < len(self.points):
+                    self._set_level(self.level + 1, f"задержка {latency or 0:.0f} мс, очередь {queue_depth}")
+            elif has_headroom:
+                self.overload_since = None
+                self.headroom_since = self.headroom_since or now
+                if now - self.headroom_since >= LOAD_STEP_UP_HOLD and self.level > 0:
+                    self._set_level(self.level - 1, f"задержка {latency:.0f} мс, очередь {queue_depth}")
+            else:
+                self.overload_since = None
+                self.headroom_since = None
+
+    def status(self):
+        with self.lock:
+            return {
+                "level": self.level, "levels": [p.name for p in self.points],
+                "operating_point": self.current.name, "switches": self.switches,
+                "latency_ema_ms": round(self.latency_ema_ms, 1) if self.latency_ema_ms is not None else None,
+                "queue_depth": self.queue_depth,
+            }
+
+
+load_controller = LoadController(build_operating_points())
+
+# --- Трекеры DeepSort: отдельный на каждую камеру ---
+def create_tracker():
+    # --- ИЗМЕНЕНИЕ ЗДЕСЬ: Параметры для mars-small128.pb ---
+    return DeepSort(
         max_iou_distance=0.7,
         max_age=30,
         n_init=3,
@@ -181,6 +513,44 @@ try:
         bgr=True,
     )
 
+
+class CameraTracker:
+    """
+    Трекер одной камеры. На экземпляр аналитики диспетчер направляет несколько камер:
+    с общим трекером детекции камеры B сопоставлялись бы с треками камеры A
+    и старили бы их. Кадры одной камеры обрабатываются параллельно несколькими
+    обработчиками, поэтому обновления трекера идут по очереди под lock.
+    """
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.lock = Lock()
+        self.last_used = time.time()
+
+
+camera_trackers = {}  # camera_id -> CameraTracker
+camera_trackers_lock = Lock()
+
+
+def get_camera_tracker(camera_id):
+    """Трекер камеры (создается при первом кадре); трекеры камер без кадров удаляются"""
+    now = time.time()
+    with camera_trackers_lock:
+        entry = camera_trackers.get(camera_id)
+        if entry is None:
+            entry = camera_trackers[camera_id] = CameraTracker(create_tracker())
+            logger.info(f"Создан трекер для камеры {camera_id}. Трекеров: {len(camera_trackers)}")
+        entry.last_used = now
+        idle = [cid for cid, e in camera_trackers.items() if now - e.last_used > TRACKER_IDLE_SECONDS]
+        for cid in idle:
+            del camera_trackers[cid]
+            logger.info(f"Трекер камеры {cid} удален: нет кадров дольше {TRACKER_IDLE_SECONDS} с")
+    return entry
+
+
+# Инициализация DeepSort (первый трекер создается при старте, чтобы ошибка конфигурации была видна сразу)
+try:
+  #  logger.info(f"Инициализация DeepSort с TensorFlow моделью '{deep_sort_model_path}'")
+    camera_trackers[DEFAULT_CAMERA_ID] = CameraTracker(create_tracker())
     logger.info("DeepSort успешно инициализирован")
 except FileNotFoundError:
     logger.error(f"Ошибка инициализации DeepSort: Файл модели не найден по пути {deep_sort_model_path}")
@@ -218,8 +588,613 @@ class Stats:
 
 stats = Stats()
 
-# --- Функция send_alert_to_api (без изменений) ---
-async def send_alert_to_api_async(track_id, bbox, confidence=1.0, class_id=0, frame_shape=None):
+
+# --- Гистограммы задержек по этапам конвейера ---
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+LATENCY_STAGES = {
+    "capture_to_receive": "Захват на камере -> прием UDP",
+    "queue_wait": "Ожидание в очереди обработки",
+    "processing": "Обработка кадра (детекция, трекинг, визуализация)",
+    "capture_to_processed": "Захват -> кадр обработан",
+    "ws_delivery": "Кадр обработан -> отправлен клиенту /ws",
+    "capture_to_ws": "Захват -> отправлен клиенту /ws",
+    "api_delivery": "Оповещение создано -> принято API",
+    "capture_to_api": "Захват -> оповещение принято API",
+}
+
+
+class LatencyHistogram:
+    """Накопительная гистограмма задержек с фиксированными границами (мс)"""
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина — +Inf
+        self.count = 0
+        self.total_ms = 0.0
+        self.lock = Lock()
+
+    def observe(self, value_ms):
+        value_ms = max(value_ms, 0.0)  # Рассинхронизация часов камеры не должна давать отрицательных значений
+        idx = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value_ms <= bound:
+                idx = i
+                break
+        with self.lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.total_ms += value_ms
+
+    def quantile(self, q):
+        """Оценка квантиля по верхней границе корзины"""
+        with self.lock:
+            if not self.count:
+                return None
+            target = q * self.count
+            cumulative = 0
+            for i, c in enumerate(self.counts):
+                cumulative += c
+                if cumulative >= target:
+                    return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return None
+
+    def summary(self):
+        with self.lock:
+            count, total = self.count, self.total_ms
+        return {
+            "count": count, "avg_ms": round(total / count, 2) if count else None,
+            "p50_ms": self.quantile(0.5), "p95_ms": self.quantile(0.95), "p99_ms": self.quantile(0.99),
+        }
+
+    def prometheus_lines(self, name, stage):
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.total_ms
+        lines = []
+        cumulative = 0
+        for bound, c in zip(self.buckets, counts):
+            cumulative += c
+            lines.append(f'{name}_bucket{{stage="{stage}",le="{bound / 1000.0}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {count}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {total / 1000.0}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+        return lines
+
+
+latency_histograms = {stage: LatencyHistogram() for stage in LATENCY_STAGES}
+
+
+def observe_latency(stage, seconds):
+    latency_histograms[stage].observe(seconds * 1000.0)
+
+
+# --- Профилирование по запросу ---
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "120"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_MAX_SAMPLES = int(os.getenv("PROFILE_MAX_SAMPLES", "200000"))  # Предел сэмплов стеков в trace
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # /admin/* требует заголовок X-Admin-Token; без токена отключены
+
+
+class ProfileSession:
+    """
+    Сессия профилирования следующих N кадров или T секунд: тайминги этапов
+    process_frame, операторный профиль torch для прямого прохода модели и
+    сэмплирование Python-стеков потоков-обработчиков. Результат собирается
+    в Chrome trace JSON (открывается в chrome://tracing или Perfetto).
+    """
+    def __init__(self, max_frames, max_seconds):
+        self.max_frames = max_frames
+        self.max_seconds = max_seconds
+        self.started_at = time.time()
+        self.frames_done = 0
+        self.events = []
+        self.stack_frames = {}  # (имя, родитель) -> id кадра стека
+        self.samples = []
+        self.samples_dropped = 0  # Сэмплы сверх PROFILE_MAX_SAMPLES учитываются только в collapsed_stacks
+        self.collapsed_stacks = {}
+        self.torch_ops = {}  # имя оператора -> [вызовы, суммарное время, мкс]
+        self.lock = Lock()
+        self.torch_lock = Lock()  # Профайлер torch глобален — одновременно профилируем один проход
+        self.done = Event()
+        self.sampler = Thread(target=self._sample_loop, daemon=True)
+        self.sampler.start()
+
+    def _us(self, t):
+        return (t - self.started_at) * 1e6
+
+    def expired(self):
+        return (self.max_frames and self.frames_done >= self.max_frames) or \
+            time.time() - self.started_at >= self.max_seconds
+
+    def record_stages(self, stages, camera_id):
+        """stages: [(имя, начало, конец), ...] в секундах time.time()"""
+        tid = threading.get_native_id()
+        with self.lock:
+            for name, start, end in stages:
+                self.events.append({
+                    "name": name, "cat": "stage", "ph": "X", "pid": os.getpid(), "tid": tid,
+                    "ts": self._us(start), "dur": (end - start) * 1e6, "args": {"camera": camera_id},
+                })
+            self.frames_done += 1
+            if self.expired():
+                self.done.set()
+
+    def profile_forward(self, forward):
+        """Прямой проход модели под профайлером torch (если он свободен)"""
+        if not self.torch_lock.acquire(blocking=False):
+            return forward()
+        try:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            forward_start = time.time()
+            with torch.profiler.profile(activities=activities) as prof:
+                result = forward()
+            self._add_torch_events(prof, forward_start)
+            return result
+        finally:
+            self.torch_lock.release()
+
+    def _add_torch_events(self, prof, forward_start):
+        events = prof.events()
+        if not events:
+            return
+        base = min(e.time_range.start for e in events)
+        tid = threading.get_native_id()
+        with self.lock:
+            for e in events:
+                self.events.append({
+                    "name": e.name, "cat": "torch_op", "ph": "X", "pid": os.getpid(), "tid": tid,
+                    "ts": self._us(forward_start) + (e.time_range.start - base),
+                    "dur": e.time_range.end - e.time_range.start,
+                })
+                op = self.torch_ops.setdefault(e.name, [0, 0.0])
+                op[0] += 1
+                op[1] += e.self_cpu_time_total
+
+    def _stack_id(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        parent = None
+        for name in reversed(stack):
+            key = (name, parent)
+            sf_id = self.stack_frames.get(key)
+            if sf_id is None:
+                sf_id = self.stack_frames[key] = len(self.stack_frames) + 1
+            parent = sf_id
+        return parent, ";".join(reversed(stack))
+
+    def _sample_loop(self):
+        # Сэмплирующий профайлер: стеки только потоков-обработчиков кадров
+        while not self.done.is_set():
+            now = time.time()
+            threads = {t.ident: t for t in threading.enumerate() if t.name.startswith(INFERENCE_THREAD_PREFIX)}
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, thread in threads.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    sf_id, collapsed = self._stack_id(frame)
+                    if len(self.samples) < PROFILE_MAX_SAMPLES:
+                        self.samples.append({"cat": "python", "name": "sample", "ph": "P", "pid": os.getpid(),
+                                             "tid": thread.native_id, "ts": self._us(now), "sf": sf_id})
+                    else:
+                        self.samples_dropped += 1
+                    self.collapsed_stacks[collapsed] = self.collapsed_stacks.get(collapsed, 0) + 1
+            if self.expired():
+                self.done.set()
+            self.done.wait(PROFILE_SAMPLE_INTERVAL)
+
+    def to_chrome_trace(self):
+        with self.lock:
+            stack_frames = {}
+            for (name, parent), sf_id in self.stack_frames.items():
+                entry = {"name": name, "category": "python"}
+                if parent is not None:
+                    entry["parent"] = parent
+                stack_frames[str(sf_id)] = entry
+            top_ops = sorted(self.torch_ops.items(), key=lambda item: item[1][1], reverse=True)[:50]
+            return {
+                "traceEvents": list(self.events) + list(self.samples),
+                "stackFrames": stack_frames,
+                "displayTimeUnit": "ms",
+                "metadata": {
+                    "started_at": self.started_at,
+                    "duration_seconds": round(time.time() - self.started_at, 3),
+                    "frames_profiled": self.frames_done,
+                    "python_samples": len(self.samples),
+                    "python_samples_dropped": self.samples_dropped,
+                    "torch_ops_self_cpu_us": {name: {"calls": c, "self_cpu_us": round(t, 1)} for name, (c, t) in top_ops},
+                    "python_collapsed_stacks": self.collapsed_stacks,
+                },
+            }
+
+
+active_profile = None  # Текущая сессия профилирования; None — профилирование выключено
+
+
+# --- Кольцевой буфер кадров и запись клипов по событиям ---
+class FrameRing:
+    """
+    Кольцевой буфер уже закодированных JPEG-датаграмм одной камеры.
+    Ограничен как по длительности (секунды), так и по суммарному объему (байты).
+    Храним байты, а не декодированные кадры: это примерно в 10 раз экономнее по памяти.
+    """
+    def __init__(self, max_seconds, max_bytes):
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.frames = deque()  # (timestamp, jpeg_bytes)
+        self.total_bytes = 0
+        self.last_timestamp = None
+
+    def append(self, timestamp, data):
+        self.frames.append((timestamp, data))
+        self.last_timestamp = timestamp
+        self.total_bytes += len(data)
+        while self.frames and (
+            self.total_bytes > self.max_bytes or
+            timestamp - self.frames[0][0] > self.max_seconds
+        ):
+            _, old_data = self.frames.popleft()
+            self.total_bytes -= len(old_data)
+
+    def snapshot(self, since):
+        return [(ts, data) for ts, data in self.frames if ts >= since]
+
+
+class PendingClip:
+    def __init__(self, camera_id, path, start_time, end_time, frames):
+        self.camera_id = camera_id
+        self.path = path
+        self.start_time = start_time
+        self.end_time = end_time
+        self.frames = frames
+        self.total_bytes = sum(len(data) for _, data in frames)
+        self.track_ids = set()
+
+
+class ClipRecorder:
+    """
+    Запись клипов вокруг событий: CLIP_PRE_SECONDS до и CLIP_POST_SECONDS после.
+    Кадры «до» берутся из кольцевого буфера в момент события, кадры «после»
+    добавляются по мере поступления. Перекрывающиеся события одной камеры
+    сливаются в один клип (не длиннее CLIP_MAX_SECONDS). Запись на диск
+    выполняется в отдельном потоке, чтобы не задерживать прием UDP.
+    """
+    def __init__(self, clip_dir, pre_seconds, post_seconds, max_seconds, clip_format,
+                 ring_seconds, ring_max_bytes, clip_max_bytes, retention_max_bytes, retention_seconds):
+        self.clip_dir = Path(clip_dir)
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.max_seconds = max_seconds
+        self.clip_format = clip_format if clip_format in ("mjpeg", "mp4") else "mjpeg"
+        self.ring_seconds = max(ring_seconds, pre_seconds)
+        self.ring_max_bytes = ring_max_bytes
+        self.clip_max_bytes = clip_max_bytes
+        self.retention_max_bytes = retention_max_bytes
+        self.retention_seconds = retention_seconds
+        self.rings = {}
+        self.active_clips = {}  # camera_id -> PendingClip
+        self.track_clips = OrderedDict()  # (camera_id, track_id) -> путь к клипу
+        self.max_tracked_ids = 1000
+        self.lock = Lock()
+        self.write_queue = deque()
+        self.wakeup = Event()
+        self.clips_written = 0
+        self.last_retention_check = 0.0
+        self.writer_thread = Thread(target=self._writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    def add_frame(self, camera_id, timestamp, data):
+        """Вызывается из цикла приема UDP для каждой датаграммы."""
+        finished = None
+        with self.lock:
+            ring = self.rings.get(camera_id)
+            if ring is None:
+                ring = self.rings[camera_id] = FrameRing(self.ring_seconds, self.ring_max_bytes)
+            ring.append(timestamp, data)
+
+            clip = self.active_clips.get(camera_id)
+            if clip is not None:
+                if timestamp > clip.end_time:
+                    finished = self.active_clips.pop(camera_id)
+                elif clip.total_bytes + len(data) > self.clip_max_bytes:
+                    # Кадры клипа держатся в памяти до записи — объем ограничен, как и у кольцевого буфера
+                    finished = self.active_clips.pop(camera_id)
+                    logger.warning(f"Клип {clip.path} достиг предела {self.clip_max_bytes} байт, запись завершена досрочно")
+                else:
+                    clip.frames.append((timestamp, data))
+                    clip.total_bytes += len(data)
+        if finished is not None:
+            self._enqueue(finished)
+
+    def clip_for_track(self, camera_id, track_id, event_time):
+        """
+        Возвращает путь к клипу для трека. Для нового трека запускает запись
+        (или присоединяет событие к уже записываемому клипу этой камеры).
+        None — в буфере камеры нет кадров, клип не будет записан.
+        """
+        key = (camera_id, str(track_id))
+        with self.lock:
+            path = self.track_clips.get(key)
+            if path is not None:
+                self.track_clips.move_to_end(key)
+                return path
+
+            clip = self.active_clips.get(camera_id)
+            if clip is not None and event_time <= clip.end_time:
+                # Дедупликация: событие попадает в окно уже записываемого клипа
+                clip.end_time = min(max(clip.end_time, event_time + self.post_seconds),
+                                    clip.start_time + self.max_seconds)
+            else:
+                start_time = event_time - self.pre_seconds
+                ring = self.rings.get(camera_id)
+                frames = ring.snapshot(start_time) if ring is not None else []
+                if not frames:
+                    # Пустой клип не записывается — оповещение не должно ссылаться на несуществующий файл
+                    return None
+                stamp = datetime.fromtimestamp(event_time).strftime('%Y%m%d_%H%M%S')
+                safe_camera = "".join(c if c.isalnum() else "_" for c in camera_id)
+                ext = "mp4" if self.clip_format == "mp4" else "mjpeg"
+                path = str(self.clip_dir / f"{safe_camera}_{stamp}_{track_id}.{ext}")
+                clip = PendingClip(camera_id, path, start_time, event_time + self.post_seconds, frames)
+                self.active_clips[camera_id] = clip
+                logger.info(f"Начата запись клипа {path} (трек {track_id}, камера {camera_id})")
+
+            clip.track_ids.add(str(track_id))
+            self.track_clips[key] = clip.path
+            while len(self.track_clips) > self.max_tracked_ids:
+                self.track_clips.popitem(last=False)
+            return clip.path
+
+    def _enqueue(self, clip):
+        with self.lock:
+            self.write_queue.append(clip)
+        self.wakeup.set()
+
+    def _expire_stale_clips(self):
+        # Камера могла перестать присылать кадры — завершаем клипы по времени
+        now = time.time()
+        with self.lock:
+            expired = [cid for cid, clip in self.active_clips.items() if now > clip.end_time + 1.0]
+            for cid in expired:
+                self.write_queue.append(self.active_clips.pop(cid))
+
+    def _expire_idle_rings(self):
+        # Камера перестала присылать кадры (или сменила адрес) — буфер больше не нужен
+        now = time.time()
+        with self.lock:
+            idle = [cid for cid, ring in self.rings.items()
+                    if cid not in self.active_clips and
+                    (ring.last_timestamp is None or now - ring.last_timestamp > self.ring_seconds)]
+            for cid in idle:
+                del self.rings[cid]
+        if idle:
+            logger.debug(f"Удалены буферы неактивных камер: {idle}")
+
+    def _enforce_retention(self):
+        """Удаление клипов старше retention_seconds и самых старых сверх retention_max_bytes"""
+        if not self.clip_dir.is_dir():
+            return
+        clips = []
+        for path in self.clip_dir.iterdir():
+            if path.suffix not in (".mjpeg", ".mp4"):
+                continue
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            clips.append((st.st_mtime, st.st_size, path))
+        clips.sort()
+        total = sum(size for _, size, _ in clips)
+        now = time.time()
+        removed = 0
+        for mtime, size, path in clips:
+            too_old = self.retention_seconds > 0 and now - mtime > self.retention_seconds
+            if not too_old and total <= self.retention_max_bytes:
+                break
+            try:
+                path.unlink()
+                removed += 1
+            except OSError as e:
+                logger.warning(f"Не удалось удалить клип {path}: {e}")
+            total -= size
+        if removed:
+            logger.info(f"Удалено старых клипов: {removed}, объем каталога {total / 1024 ** 2:.1f} МБ")
+
+    def _writer_loop(self):
+        while True:
+            self.wakeup.wait(timeout=1.0)
+            self.wakeup.clear()
+            self._expire_stale_clips()
+            self._expire_idle_rings()
+            if time.time() - self.last_retention_check > 60:
+                self.last_retention_check = time.time()
+                self._enforce_retention()
+            while True:
+                with self.lock:
+                    if not self.write_queue:
+                        break
+                    clip = self.write_queue.popleft()
+                try:
+                    self._write_clip(clip)
+                    self._enforce_retention()
+                except Exception as e:
+                    logger.error(f"Ошибка записи клипа {clip.path}: {e}", exc_info=True)
+
+    def _write_clip(self, clip):
+        if not clip.frames:
+            logger.warning(f"Клип {clip.path} пуст, запись пропущена")
+            return
+        self.clip_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = clip.path + ".part"
+        if self.clip_format == "mp4":
+            self._write_mp4(clip, tmp_path)
+        else:
+            # MJPEG — просто последовательность JPEG без перекодирования
+            with open(tmp_path, "wb") as f:
+                for _, data in clip.frames:
+                    f.write(data)
+        os.replace(tmp_path, clip.path)
+        self.clips_written += 1
+        duration = clip.frames[-1][0] - clip.frames[0][0]
+        logger.info(f"Клип сохранен: {clip.path} ({len(clip.frames)} кадров, {duration:.1f} с, "
+                    f"треки: {', '.join(sorted(clip.track_ids))})")
+
+    def _write_mp4(self, clip, tmp_path):
+        duration = clip.frames[-1][0] - clip.frames[0][0]
+        fps = (len(clip.frames) - 1) / duration if duration > 0 else 10.0
+        writer = None
+        try:
+            for _, data in clip.frames:
+                frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if frame is None:
+                    continue
+                if writer is None:
+                    h, w = frame.shape[:2]
+                    writer = cv2.VideoWriter(tmp_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (w, h))
+                writer.write(frame)
+        finally:
+            if writer is not None:
+                writer.release()
+
+    def buffered_bytes(self):
+        with self.lock:
+            return sum(ring.total_bytes for ring in self.rings.values())
+
+
+clip_recorder = ClipRecorder(
+    CLIP_DIR, CLIP_PRE_SECONDS, CLIP_POST_SECONDS, CLIP_MAX_SECONDS, CLIP_FORMAT,
+    FRAME_RING_SECONDS, FRAME_RING_MAX_BYTES, CLIP_MAX_BYTES, CLIP_RETENTION_MAX_BYTES, CLIP_RETENTION_SECONDS,
+) if CLIP_RECORDING_ENABLED else None
+
+# --- Снимки треков ---
+class SnapshotTracker:
+    """
+    Для каждого трека хранит уверенность и id лучшего снимка. Кроп кодируется в JPEG
+    только когда уверенность выросла больше чем на SNAPSHOT_MIN_IMPROVEMENT, так что
+    затраты CPU ограничены несколькими кодированиями на трек. Id снимка — sha256 JPEG,
+    тот же ключ, под которым API хранит снимок.
+    Снимок становится лучшим только после того, как API его принял (confirm): до этого
+    он «в отправке» (pending), и оповещения ссылаются на предыдущий принятый снимок.
+    Неудачная отправка снимает pending, и снимок трека будет снят заново на следующем кадре.
+    """
+    def __init__(self, max_tracks=2000):
+        self.best = OrderedDict()  # (camera_id, track_id) -> (уверенность, id снимка), принятые API
+        self.pending = {}  # (camera_id, track_id) -> уверенность снимка в отправке
+        self.max_tracks = max_tracks
+        self.lock = Lock()
+        self.encoded = 0
+
+    def snapshot_id(self, camera_id, track_id):
+        with self.lock:
+            entry = self.best.get((camera_id, str(track_id)))
+            return entry[1] if entry else None
+
+    def maybe_capture(self, camera_id, track_id, confidence, frame, ltrb):
+        """Возвращает (id, jpeg_bytes) нового лучшего снимка или None; снимок остается pending до confirm"""
+        if confidence is None:
+            return None
+        key = (camera_id, str(track_id))
+        with self.lock:
+            if key in self.pending:
+                return None  # Не больше одной отправки на трек одновременно
+            entry = self.best.get(key)
+            if entry is not None and confidence < entry[0] + SNAPSHOT_MIN_IMPROVEMENT:
+                return None
+            self.pending[key] = confidence
+
+        snapshot = self._encode(frame, ltrb)
+        with self.lock:
+            if snapshot is None:
+                self.pending.pop(key, None)
+            else:
+                self.encoded += 1
+        return snapshot
+
+    def _encode(self, frame, ltrb):
+        h, w = frame.shape[:2]
+        x1, y1, x2, y2 = ltrb
+        pad_x, pad_y = (x2 - x1) * SNAPSHOT_PADDING, (y2 - y1) * SNAPSHOT_PADDING
+        x1, y1 = max(0, int(x1 - pad_x)), max(0, int(y1 - pad_y))
+        x2, y2 = min(w, int(x2 + pad_x)), min(h, int(y2 + pad_y))
+        if x2 <= x1 or y2 <= y1:
+            return None
+        result, encoded_img = cv2.imencode('.jpg', frame[y1:y2, x1:x2],
+                                           [int(cv2.IMWRITE_JPEG_QUALITY), SNAPSHOT_JPEG_QUALITY])
+        if not result:
+            return None
+        jpeg_bytes = encoded_img.tobytes()
+        return hashlib.sha256(jpeg_bytes).hexdigest(), jpeg_bytes
+
+    def confirm(self, camera_id, track_id, confidence, snapshot_id, accepted):
+        """Результат отправки снимка: принятый API снимок становится лучшим для трека"""
+        key = (camera_id, str(track_id))
+        with self.lock:
+            self.pending.pop(key, None)
+            if not accepted:
+                return
+            entry = self.best.get(key)
+            if entry is None or confidence >= entry[0]:
+                self.best[key] = (confidence, snapshot_id)
+            self.best.move_to_end(key)
+            while len(self.best) > self.max_tracks:
+                self.best.popitem(last=False)
+
+
+snapshot_tracker = SnapshotTracker() if SNAPSHOTS_ENABLED else None
+
+
+async def send_snapshot_to_api_async(snapshot_id, jpeg_bytes, track_id, confidence, camera_id):
+    """Возвращает True, если API принял снимок"""
+    try:
+        def send_post():
+            with requests.Session() as session:
+                return session.post(
+                    f"{API_URL}/snapshots",
+                    params={"track_id": str(track_id), "camera": camera_id, "confidence": float(confidence)},
+                    data=jpeg_bytes, headers={"Content-Type": "image/jpeg"}, timeout=2.0,
+                )
+
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, send_post)
+        if response.status_code in [200, 201]:
+            logger.debug(f"Снимок {snapshot_id[:12]} отправлен для объекта {track_id}")
+            return True
+        logger.warning(f"Ошибка при отправке снимка в API (статус {response.status_code}): {response.text}")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Ошибка соединения с API при отправке снимка: {e}")
+    except Exception as e:
+        logger.error(f"Непредвиденная ошибка при отправке снимка: {e}", exc_info=True)
+    return False
+
+
+async def send_snapshot_and_alert_async(snapshot, track_id, bbox, confidence, class_id,
+                                        frame_shape, camera_id, clip_path, capture_ts, created_at):
+    """
+    Новый лучший снимок отправляется до оповещения, которое на него ссылается: клиент,
+    получивший оповещение, сразу может запросить снимок. Если снимок не принят,
+    оповещение ссылается на предыдущий принятый снимок трека.
+    """
+    new_snapshot_id, jpeg_bytes = snapshot
+    accepted = await send_snapshot_to_api_async(new_snapshot_id, jpeg_bytes, track_id, confidence, camera_id)
+    snapshot_tracker.confirm(camera_id, track_id, confidence, new_snapshot_id, accepted)
+    snapshot_id = snapshot_tracker.snapshot_id(camera_id, track_id)
+    await send_alert_to_api_async(track_id, bbox, confidence, class_id, frame_shape=frame_shape, camera_id=camera_id,
+                                  clip_path=clip_path, capture_ts=capture_ts, snapshot_id=snapshot_id,
+                                  created_at=created_at)
+
+
+# --- Функция send_alert_to_api (время захвата, ссылки на клип и снимок) ---
+async def send_alert_to_api_async(track_id, bbox, confidence=1.0, class_id=0, frame_shape=None,
+                                  camera_id=DEFAULT_CAMERA_ID, clip_path=None, capture_ts=None, snapshot_id=None,
+                                  created_at=None):
+    # created_at — момент создания оповещения в process_frame: в api_delivery входят ожидание
+    # в event loop и отправка снимка, на который ссылается оповещение
+    if created_at is None:
+        created_at = time.time()
     try:
         if frame_shape:
             h, w = frame_shape[:2]
@@ -230,11 +1205,16 @@ async def send_alert_to_api_async(track_id, bbox, confidence=1.0, class_id=0, fr
         else:
             norm_bbox = bbox.tolist() if hasattr(bbox, 'tolist') else list(bbox)
 
+        # Время оповещения — момент захвата кадра, если камера его передала
         data = {
-            "timestamp": time.time(), "track_id": str(track_id),
+            "timestamp": capture_ts if capture_ts is not None else created_at, "track_id": str(track_id),
             "bbox_normalized": norm_bbox, "confidence": float(confidence),
-            "class_id": int(class_id), "source_info": "camera_udp_0"
+            "class_id": int(class_id), "source_info": camera_id
         }
+        if clip_path:
+            data["clip_path"] = clip_path
+        if snapshot_id:
+            data["snapshot_id"] = snapshot_id
 
         def send_post():
             with requests.Session() as session:
@@ -244,6 +1224,10 @@ async def send_alert_to_api_async(track_id, bbox, confidence=1.0, class_id=0, fr
         response = await loop.run_in_executor(None, send_post)
 
         if response.status_code in [200, 201]:
+            delivered_at = time.time()
+            observe_latency("api_delivery", delivered_at - created_at)
+            if capture_ts is not None:
+                observe_latency("capture_to_api", delivered_at - capture_ts)
             logger.debug(f"Оповещение успешно отправлено для объекта {track_id}")
         else:
             logger.warning(f"Ошибка при отправке оповещения API (статус {response.status_code}): {response.text}")
@@ -270,10 +1254,16 @@ def preprocess(img, target_size, model_stride):
     return img, img0
 
 
-# --- Функция process_frame (без изменений в логике, только вызов send_alert_to_api) ---
-def process_frame(frame_data):
-    global latest_processed_frame
+# --- Функция process_frame (режим лестницы, клипы, снимки, профилирование, журнал кадров) ---
+def process_frame(frame_data, camera_id=DEFAULT_CAMERA_ID, received_at=None, seq=None, capture_ts=None):
+    global latest_processed_frame, frame_version, processed_log_id, latest_frame_times
     frame_receive_time = time.time()
+    profile = active_profile
+    if received_at is None:
+        received_at = frame_receive_time
+    observe_latency("queue_wait", frame_receive_time - received_at)
+    if capture_ts is not None:
+        observe_latency("capture_to_receive", received_at - capture_ts)
 
     if frame_data is None:
         logger.warning("Получен пустой кадр (None) для обработки.")
@@ -291,11 +1281,15 @@ def process_frame(frame_data):
             logger.error(f"Неподдерживаемый тип кадра: {type(frame_data)}")
             return None
 
-        img_tensor, img0 = preprocess(frame, img_size, stride)
+        op = load_controller.current
+        img_tensor, img0 = preprocess(frame, op.img_size, op.stride)
         preprocess_end_time = time.time()
 
         with torch.no_grad():
-            pred = model(img_tensor, augment=False, visualize=False)
+            if profile is not None:
+                pred = profile.profile_forward(lambda: op.model(img_tensor, augment=False, visualize=False))
+            else:
+                pred = op.model(img_tensor, augment=False, visualize=False)
         detect_end_time = time.time()
 
         pred_boxes = non_max_suppression(pred, CONFIDENCE_THRESHOLD, IOU_THRESHOLD, classes=None, agnostic=False, max_det=1000)[0]
@@ -319,32 +1313,50 @@ def process_frame(frame_data):
 
         processed_frame_vis = img0.copy()
 
-        if detections_for_tracker:
-            tracks = tracker.update_tracks(detections_for_tracker, frame=img0)
-        else:
-            tracks = tracker.update_tracks([], frame=img0)
+        camera_tracker = get_camera_tracker(camera_id)
+        with camera_tracker.lock:
+            tracks = camera_tracker.tracker.update_tracks(detections_for_tracker, frame=img0)
+            # Состояние треков копируется под lock: следующий кадр камеры изменит объекты треков
+            active_tracks = [
+                (track.track_id, track.to_ltrb(), track.get_det_class(), track.get_det_conf(), track.time_since_update)
+                for track in tracks if track.is_confirmed() and track.time_since_update <= 1
+            ]
         track_end_time = time.time()
 
         tracked_count = 0
-        for track in tracks:
-            if not track.is_confirmed() or track.time_since_update > 1:
-                continue
+        for track_id, ltrb, class_id, confidence, time_since_update in active_tracks:
             tracked_count += 1
-            track_id = track.track_id
-            ltrb = track.to_ltrb()
-            class_id = track.get_det_class()
-            confidence = track.get_det_conf()
 
             x1, y1, x2, y2 = map(int, ltrb)
             cv2.rectangle(processed_frame_vis, (x1, y1), (x2, y2), (0, 255, 0), 2)
             cv2.putText(processed_frame_vis, f"ID:{track_id} C:{confidence:.2f}", (x1, y1 - 10),
                         cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
 
-            if track.time_since_update == 0:
-                asyncio.run_coroutine_threadsafe(
-                    send_alert_to_api_async(track_id, ltrb, confidence, class_id, frame_shape=img0.shape),
-                    main_event_loop
-                )
+            if time_since_update == 0 and alerts_enabled:
+                alert_created_at = time.time()
+                clip_path = None
+                if clip_recorder is not None:
+                    clip_path = clip_recorder.clip_for_track(camera_id, track_id, received_at)
+                snapshot_id = None
+                snapshot = None
+                if snapshot_tracker is not None:
+                    snapshot_id = snapshot_tracker.snapshot_id(camera_id, track_id)
+                    # Кроп с исходного кадра, без рамок визуализации
+                    snapshot = snapshot_tracker.maybe_capture(camera_id, track_id, confidence, img0, ltrb)
+                if snapshot is not None:
+                    asyncio.run_coroutine_threadsafe(
+                        send_snapshot_and_alert_async(snapshot, track_id, ltrb, confidence, class_id,
+                                                      img0.shape, camera_id, clip_path, capture_ts,
+                                                      alert_created_at),
+                        main_event_loop
+                    )
+                else:
+                    asyncio.run_coroutine_threadsafe(
+                        send_alert_to_api_async(track_id, ltrb, confidence, class_id, frame_shape=img0.shape,
+                                                camera_id=camera_id, clip_path=clip_path, capture_ts=capture_ts,
+                                                snapshot_id=snapshot_id, created_at=alert_created_at),
+                        main_event_loop
+                    )
 
         vis_end_time = time.time()
 
@@ -355,10 +1367,33 @@ def process_frame(frame_data):
         cv2.putText(processed_frame_vis, f"Detect:{detected_count} Track:{tracked_count}", (10, 60),
                     cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
 
+        processed_at = time.time()
         with frame_lock:
             latest_processed_frame = processed_frame_vis
+            frame_version += 1
+            latest_frames[camera_id] = (frame_version, processed_frame_vis, processed_at, capture_ts)
+            latest_frame_times = (processed_at, capture_ts)
+            if seq is not None:
+                processed_log_id += 1
+                processed_log.append((processed_log_id, camera_id, seq, capture_ts, processed_at))
         update_glob_end_time = time.time()
 
+        observe_latency("processing", processed_at - frame_receive_time)
+        load_controller.observe(processed_at - received_at)
+        if profile is not None:
+            profile.record_stages([
+                ("process_frame", frame_receive_time, update_glob_end_time),
+                ("preprocess", frame_receive_time, preprocess_end_time),
+                ("detect", preprocess_end_time, detect_end_time),
+                ("nms", detect_end_time, nms_end_time),
+                ("scale", nms_end_time, scale_end_time),
+                ("track", scale_end_time, track_end_time),
+                ("visualize", track_end_time, vis_end_time),
+                ("publish", vis_end_time, update_glob_end_time),
+            ], camera_id)
+        if capture_ts is not None:
+            observe_latency("capture_to_processed", processed_at - capture_ts)
+
         logger.debug(
             f"Frame timing: Preproc: {(preprocess_end_time - frame_receive_time)*1000:.1f}ms, "
             f"Detect: {(detect_end_time - preprocess_end_time)*1000:.1f}ms, NMS: {(nms_end_time - detect_end_time)*1000:.1f}ms, "
@@ -375,6 +1410,12 @@ def process_frame(frame_data):
         return None
 
 
+def process_queued_frame(*args):
+    """Кадр из цикла приема UDP: снимается со счетчика очереди контроллера нагрузки и обрабатывается"""
+    load_controller.frame_started()
+    return process_frame(*args)
+
+
 # --- Endpoint /health (без изменений) ---
 @app.get("/health")
 async def health_check():
@@ -384,50 +1425,213 @@ async def health_check():
         "processing_fps": round(stats.fps, 2), "last_detected_objects": stats.detected_objects,
         "last_tracked_objects": stats.tracked_objects, "total_frames_processed": stats.processed_frames_total,
         "compute_device": str(device), "yolo_model": model_path,
-        "deepsort_model": deep_sort_model_path, "active_ws_connections": len(connected_websockets)
+        "load_shedding": load_controller.status(),
+        "snapshots_encoded": snapshot_tracker.encoded if snapshot_tracker is not None else 0,
+        "execution_plan": {k: v for k, v in execution_plan.items() if k != "cpu_affinity"},
+        "deepsort_model": deep_sort_model_path, "camera_trackers": len(camera_trackers),
+        "active_ws_connections": len(connected_websockets),
+        "ws_clients_per_tier": {tier: list(connected_websockets.values()).count(tier) for tier in WS_TIER_ORDER},
+        "clips_written": clip_recorder.clips_written if clip_recorder is not None else 0,
+        "frame_ring_bytes": clip_recorder.buffered_bytes() if clip_recorder is not None else 0,
     }
 
 
-# --- WebSocket /ws (без изменений) ---
+# --- Профилирование по запросу ---
+@app.post("/admin/profile")
+async def capture_profile(request: Request, frames: int = 100, seconds: float = 10.0):
+    """
+    Профилирование следующих `frames` кадров или `seconds` секунд (что наступит раньше;
+    frames=0 — только по времени). Возвращает Chrome trace JSON для скачивания.
+    """
+    global active_profile
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Profiling is disabled: ADMIN_TOKEN is not configured")
+    if request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    if active_profile is not None:
+        raise HTTPException(status_code=409, detail="Profiling session already in progress")
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+
+    session = ProfileSession(max(frames, 0), seconds)
+    active_profile = session
+    logger.info(f"Профилирование запущено: до {frames} кадров / {seconds} с")
+    try:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, session.done.wait, seconds + 1.0)
+    finally:
+        session.done.set()
+        active_profile = None
+    await loop.run_in_executor(None, session.sampler.join, 1.0)
+    # Сборка и сериализация trace занимают заметное время — вне event loop, чтобы не задерживать /ws
+    content = await loop.run_in_executor(None, lambda: json.dumps(session.to_chrome_trace()))
+    logger.info(f"Профилирование завершено: кадров {session.frames_done}, сэмплов {len(session.samples)}")
+    filename = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    return Response(content=content, media_type="application/json",
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+# --- Метрики задержек ---
+@app.get("/latency")
+async def get_latency():
+    """Сводка задержек по этапам конвейера (квантили оцениваются по корзинам гистограммы)"""
+    return {stage: latency_histograms[stage].summary() for stage in LATENCY_STAGES}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    name = "vision_frame_latency_seconds"
+    lines = [
+        f"# HELP {name} Задержка кадра по этапам конвейера",
+        f"# TYPE {name} histogram",
+    ]
+    for stage in LATENCY_STAGES:
+        lines.extend(latency_histograms[stage].prometheus_lines(name, stage))
+    lines.extend([
+        "# TYPE vision_processing_fps gauge",
+        f"vision_processing_fps {stats.fps}",
+        "# TYPE vision_frames_processed_total counter",
+        f"vision_frames_processed_total {stats.processed_frames_total}",
+    ])
+    return "\n".join(lines) + "\n"
+
+
+# --- Журнал обработанных кадров (для генератора нагрузки) ---
+@app.get("/frames/processed")
+async def get_processed_frames(after: int = 0, limit: int = 5000):
+    """
+    Кадры с заголовком VSF1, обработанные после записи с id=after.
+    after<0 — только id последней записи (начальный курсор без чтения журнала).
+    """
+    if after < 0:
+        with frame_lock:
+            return {"frames": [], "last_id": processed_log_id}
+    with frame_lock:
+        records = [r for r in processed_log if r[0] > after][:limit]
+    return {
+        "frames": [
+            {"id": r[0], "camera": r[1], "seq": r[2], "capture_ts": r[3], "processed_at": r[4]}
+            for r in records
+        ],
+        "last_id": records[-1][0] if records else after,
+    }
+
+
+# --- Уровни качества WebSocket-потока ---
+class TierEncoder:
+    """
+    Кодирует кадр один раз на уровень качества и камеру: все подписчики
+    одного уровня получают одну и ту же закодированную строку. Стоимость
+    кодирования ограничена числом уровней, а не числом клиентов.
+    """
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.cache = {}  # (tier, camera_id) -> (версия кадра, data URL, время обработки, время захвата)
+        self.encoded_frames = 0
+
+    def latest(self, camera_id):
+        with frame_lock:
+            if camera_id is None:
+                return (frame_version, latest_processed_frame) + latest_frame_times
+            return latest_frames.get(camera_id, (0, None, None, None))
+
+    def get(self, tier, camera_id=None):
+        version, frame, processed_at, capture_ts = self.latest(camera_id)
+        if frame is None:
+            return 0, None, None, None
+        key = (tier, camera_id)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached
+
+        params = self.tiers[tier]
+        width = int(params.get("width", 0))
+        if width and frame.shape[1] > width:
+            height = int(frame.shape[0] * width / frame.shape[1])
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), int(params.get("quality", JPEG_QUALITY))]
+        result, encoded_img = cv2.imencode('.jpg', frame, encode_param)
+        if not result:
+            logger.warning(f"Ошибка кодирования кадра в JPEG для уровня {tier}")
+            return version, None, None, None
+        base64_img = base64.b64encode(encoded_img).decode('utf-8')
+        entry = (version, f"data:image/jpeg;base64,{base64_img}", processed_at, capture_ts)
+        self.cache[key] = entry
+        self.encoded_frames += 1
+        return entry
+
+
+tier_encoder = TierEncoder(WS_TIERS)
+
+
+# --- WebSocket /ws ---
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
+    """
+    Параметры подключения: ?tier=high|medium|low (см. WS_TIERS) и ?camera=<id>.
+    Клиент, который не успевает принимать кадры, переводится на уровень ниже.
+    """
     global connected_websockets
     if len(connected_websockets) >= MAX_CONNECTIONS:
         logger.warning(f"Отказ в WebSocket подключении: превышен лимит ({MAX_CONNECTIONS})")
         await websocket.close(code=1008, reason="Max connections reached")
         return
 
+    tier = websocket.query_params.get("tier", WS_DEFAULT_TIER)
+    if tier not in WS_TIERS:
+        await websocket.close(code=1008, reason=f"Unknown tier, available: {', '.join(WS_TIER_ORDER)}")
+        return
+    camera_id = websocket.query_params.get("camera")
+
     await websocket.accept()
-    connected_websockets.add(websocket)
+    connected_websockets[websocket] = tier
     client_host = websocket.client.host
     client_port = websocket.client.port
-    logger.info(f"WebSocket клиент подключен: {client_host}:{client_port}. Активных: {len(connected_websockets)}")
+    logger.info(f"WebSocket клиент подключен: {client_host}:{client_port}, уровень {tier}, "
+                f"камера {camera_id or 'любая'}. Активных: {len(connected_websockets)}")
 
+    last_sent_version = 0
+    slow_sends = 0
     try:
         while True:
-            with frame_lock:
-                frame_to_send = latest_processed_frame
-            if frame_to_send is not None:
+            frame_interval = 1.0 / max(float(WS_TIERS[tier].get("fps", 25)), 0.1)
+            loop_start = time.monotonic()
+            version, payload, processed_at, capture_ts = tier_encoder.get(tier, camera_id)
+            if payload is not None and version != last_sent_version:
+                send_start = time.monotonic()
                 try:
-                    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY]
-                    result, encoded_img = cv2.imencode('.jpg', frame_to_send, encode_param)
-                    if result:
-                        base64_img = base64.b64encode(encoded_img).decode('utf-8')
-                        await websocket.send_text(f"data:image/jpeg;base64,{base64_img}")
-                    else:
-                        logger.warning("Ошибка кодирования кадра в JPEG для WebSocket")
+                    await websocket.send_text(payload)
+                    last_sent_version = version
+                    sent_at = time.time()
+                    if processed_at is not None:
+                        observe_latency("ws_delivery", sent_at - processed_at)
+                    if capture_ts is not None:
+                        observe_latency("capture_to_ws", sent_at - capture_ts)
                 except WebSocketDisconnect:
                     logger.info(f"WebSocket клиент {client_host}:{client_port} отключился во время отправки.")
                     break
                 except Exception as e:
                     logger.error(f"Ошибка отправки кадра по WebSocket: {e}")
-            await asyncio.sleep(0.020) # ~50 FPS cap for sending
+
+                # Отправка дольше интервала кадра означает, что клиент не успевает.
+                # Кодирование кадра (общее для уровня) в это время не входит
+                send_duration = time.monotonic() - send_start
+                slow_sends = slow_sends + 1 if send_duration > frame_interval else 0
+                tier_index = WS_TIER_ORDER.index(tier)
+                if slow_sends >= WS_SLOW_SENDS_TO_DOWNGRADE and tier_index + 1 < len(WS_TIER_ORDER):
+                    tier = WS_TIER_ORDER[tier_index + 1]
+                    connected_websockets[websocket] = tier
+                    slow_sends = 0
+                    logger.info(f"WebSocket клиент {client_host}:{client_port} не успевает, "
+                                f"переведен на уровень {tier}")
+            elapsed = time.monotonic() - loop_start
+            await asyncio.sleep(max(frame_interval - elapsed, 0.005))
     except WebSocketDisconnect:
         logger.info(f"WebSocket клиент {client_host}:{client_port} штатно отключился.")
     except Exception as e:
         logger.error(f"Ошибка WebSocket соединения с {client_host}:{client_port}: {e}", exc_info=True)
     finally:
-        connected_websockets.discard(websocket)
+        connected_websockets.pop(websocket, None)
         logger.info(f"WebSocket клиент {client_host}:{client_port} удален. Активных: {len(connected_websockets)}")
 
 
@@ -441,7 +1645,23 @@ def start_websocket_server():
         sys.exit(1)
 
 
-# --- Функция udp_receiver_loop (без изменений) ---
+def parse_frame_datagram(data, addr):
+    """
+    Разбор датаграммы: (camera_id, seq, capture_ts, jpeg_bytes).
+    Без заголовка камера определяется по адресу отправителя, seq и capture_ts равны None.
+    Нулевое время захвата в заголовке (его ставит диспетчер) также означает «метаданных нет».
+    """
+    if len(data) >= FRAME_HEADER.size and data.startswith(FRAME_HEADER_MAGIC):
+        _, seq, capture_ts, id_len = FRAME_HEADER.unpack_from(data)
+        offset = FRAME_HEADER.size + id_len
+        camera_id = data[FRAME_HEADER.size:offset].decode("utf-8", errors="replace")
+        if not capture_ts:
+            seq, capture_ts = None, None
+        return camera_id, seq, capture_ts, data[offset:]
+    return f"{addr[0]}:{addr[1]}", None, None, data
+
+
+# --- Функция udp_receiver_loop ---
 def udp_receiver_loop():
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -455,7 +1675,7 @@ def udp_receiver_loop():
     frame_counter = 0
     last_log_time = time.time()
     futures = []
-    MAX_QUEUE_SIZE = 10
+    camera_frame_counters = {}
 
     while True:
         try:
@@ -467,13 +1687,26 @@ def udp_receiver_loop():
                 continue
 
             frame_counter += 1
+            camera_id, seq, capture_ts, data = parse_frame_datagram(data, addr)
+
+            # Кадр попадает в кольцевой буфер до проверки очереди, чтобы клипы не теряли кадры.
+            # Служебные датаграммы (например, CONNECTION_TEST) в клип не пишутся
+            if clip_recorder is not None and data.startswith(JPEG_SOI):
+                clip_recorder.add_frame(camera_id, receive_time, data)
+
+            # Пропуск кадров в облегченных режимах лестницы (считается отдельно по каждой камере)
+            frame_skip = load_controller.current.frame_skip
+            camera_frame_counters[camera_id] = camera_frame_counters.get(camera_id, 0) + 1
+            if frame_skip > 1 and camera_frame_counters[camera_id] % frame_skip != 0:
+                continue
 
             if len(futures) >= MAX_QUEUE_SIZE:
                 logger.warning(f"Очередь обработки кадров достигла лимита ({MAX_QUEUE_SIZE}). Пропускаем кадр.")
                 futures = [f for f in futures if not f.done()]
                 continue
 
-            future = executor.submit(process_frame, data[:])
+            load_controller.frame_queued()
+            future = executor.submit(process_queued_frame, data[:], camera_id, receive_time, seq, capture_ts)
             futures.append(future)
 
             if frame_counter % 10 == 0:
@@ -493,6 +1726,8 @@ def udp_receiver_loop():
                 logger.info(f"Получено ~{frame_counter} кадров за последнюю минуту. Активных WebSocket: {len(connected_websockets)}. Очередь обработки: {len(futures)}.")
                 frame_counter = 0
                 last_log_time = current_time
+                # Счетчики пропуска сбрасываются раз в минуту, иначе id ушедших камер копились бы бесконечно
+                camera_frame_counters = {}
 
         except socket.timeout:
             logger.warning("Таймаут приема UDP пакета.")
@@ -505,8 +1740,144 @@ def udp_receiver_loop():
     sock.close()
 
 
-# --- Точка входа __main__ (без изменений) ---
+# --- Замер производительности и автоподбор плана выполнения ---
+def run_benchmark(seconds):
+    """
+    Прогон кадров BENCHMARK_VIDEO через process_frame с текущим планом выполнения.
+    В очереди держится столько кадров, сколько обработчиков (но не больше MAX_QUEUE_SIZE,
+    как в рабочем цикле приема). Результат печатается
+    строкой BENCHMARK_RESULT {json} для --autotune.
+    """
+    global alerts_enabled
+    alerts_enabled = False
+    load_controller.enabled = False  # Замеряется план выполнения, а не лестница режимов
+
+    cap = cv2.VideoCapture(BENCHMARK_VIDEO)
+    frames = []
+    while len(frames) < 200:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        result, buffer = cv2.imencode('.jpg', cv2.resize(frame, (640, 480)), [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+        if result:
+            frames.append(buffer.tobytes())
+    cap.release()
+    if not frames:
+        logger.error(f"Не удалось прочитать кадры из {BENCHMARK_VIDEO}")
+        sys.exit(1)
+
+    for data in frames[:5]:  # Прогрев
+        process_frame(data)
+
+    def timed(data):
+        start = time.perf_counter()
+        process_frame(data)
+        return time.perf_counter() - start
+
+    workers = min(execution_plan["inference_workers"], MAX_QUEUE_SIZE)
+    latencies = []
+    in_flight = deque()
+    processed = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        while len(in_flight) < workers:
+            in_flight.append(executor.submit(timed, frames[processed % len(frames)]))
+            processed += 1
+        latencies.append(in_flight.popleft().result())
+    for future in in_flight:
+        latencies.append(future.result())
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        "fps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 1),
+        "frames": len(latencies),
+    }
+    print("BENCHMARK_RESULT " + json.dumps(result), flush=True)
+    return result
+
+
+def autotune(seconds):
+    """
+    Перебор планов выполнения: для каждого запускается отдельный процесс с --benchmark
+    (потоки torch задаются только при старте процесса). Лучший по FPS план
+    сохраняется в EXECUTION_PLAN_PATH и подхватывается при следующем запуске.
+    """
+    cores = execution_plan["cpu_affinity"]
+    n_cores = len(cores)
+    worker_counts = sorted({w for w in (1, 2, 4, 8, 16, 32) if w <= n_cores} | {n_cores})
+    candidates = []
+    for workers in worker_counts:
+        intra = max(1, n_cores // workers)
+        # Несколько обработчиков сами занимают ядра — OpenCV в один поток; при одном
+        # обработчике OpenCV оставляет свой пул по умолчанию (-1 — не менять)
+        for pin in ([False, True] if workers > 1 else [False]):
+            candidates.append({
+                "inference_workers": workers, "torch_intra_op_threads": intra,
+                "torch_inter_op_threads": 1, "opencv_threads": 1 if workers > 1 else -1,
+                "pin_workers": pin,
+            })
+
+    logger.info(f"Автоподбор плана выполнения: {len(candidates)} вариантов по {seconds} с на {n_cores} ядрах")
+    results = []
+    for candidate in candidates:
+        env = dict(os.environ)
+        env.update({
+            "INFERENCE_WORKERS": str(candidate["inference_workers"]),
+            "TORCH_INTRA_OP_THREADS": str(candidate["torch_intra_op_threads"]),
+            "TORCH_INTER_OP_THREADS": str(candidate["torch_inter_op_threads"]),
+            "OPENCV_THREADS": str(candidate["opencv_threads"]),
+            "PIN_WORKERS": str(candidate["pin_workers"]).lower(),
+            "CPU_AFFINITY": ",".join(str(c) for c in cores),
+        })
+        try:
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--benchmark", "--seconds", str(seconds)],
+                                  env=env, capture_output=True, text=True, timeout=seconds * 3 + 300)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Вариант {candidate} не завершился вовремя")
+            continue
+        lines = [line for line in proc.stdout.splitlines() if line.startswith("BENCHMARK_RESULT ")]
+        if proc.returncode != 0 or not lines:
+            logger.warning(f"Вариант {candidate} завершился с ошибкой (код {proc.returncode})")
+            continue
+        result = json.loads(lines[-1][len("BENCHMARK_RESULT "):])
+        logger.info(f"{candidate} -> {result['fps']} FPS, p95 {result['p95_ms']} мс")
+        results.append((result, candidate))
+
+    if not results:
+        logger.error("Ни один вариант плана выполнения не отработал")
+        sys.exit(1)
+    best_result, best = max(results, key=lambda r: r[0]["fps"])
+    plan = dict(best)
+    if execution_plan["pin_process"]:
+        plan["cpu_affinity"] = ",".join(str(c) for c in cores)
+    plan["benchmark"] = best_result
+    plan["host"] = socket.gethostname()
+    plan["tuned_at"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    os.makedirs(os.path.dirname(os.path.abspath(EXECUTION_PLAN_PATH)), exist_ok=True)
+    with open(EXECUTION_PLAN_PATH, "w") as f:
+        json.dump(plan, f, indent=2)
+    logger.info(f"Лучший план: {best} ({best_result['fps']} FPS). Сохранен в {EXECUTION_PLAN_PATH}")
+    return plan
+
+
+# --- Точка входа __main__ ---
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Vision Analytics Service")
+    parser.add_argument("--benchmark", action="store_true", help="Замер FPS на BENCHMARK_VIDEO с текущим планом")
+    parser.add_argument("--autotune", action="store_true", help="Подбор плана выполнения для этого хоста")
+    parser.add_argument("--seconds", type=float, default=20.0, help="Длительность замера одного варианта")
+    cli_args = parser.parse_args()
+    if cli_args.benchmark:
+        run_benchmark(cli_args.seconds)
+        sys.exit(0)
+    if cli_args.autotune:
+        autotune(cli_args.seconds)
+        sys.exit(0)
+
     logger.info("Запуск сервиса Vision Analytics...")
     ws_thread = Thread(target=start_websocket_server, daemon=True)
     ws_thread.start()
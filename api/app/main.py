@@ -1,12 +1,25 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from functools import lru_cache
+from pydantic import BaseModel, conlist, field_validator
 from typing import List, Dict, Any, Optional
+from collections import OrderedDict, deque
+from threading import Lock
 import time
 import json
 import os
+import re
+import uuid
+import hashlib
 from datetime import datetime
 
+try:
+    import orjson
+except ImportError:  # Необязательная зависимость: без нее используется стандартный json
+    orjson = None
+
 # Инициализация FastAPI
 app = FastAPI(title="Vision System API")
 
@@ -27,12 +40,366 @@ class Alert(BaseModel):
     bbox: Optional[List[float]] = None
     confidence: Optional[float] = None
     message: Optional[str] = None
+    clip_path: Optional[str] = None
+    bbox_normalized: Optional[List[float]] = None
+    class_id: Optional[int] = None
+    source_info: Optional[str] = None
+    snapshot_id: Optional[str] = None
+
+
+Point = conlist(float, min_length=2, max_length=2)  # Нормализованная точка [x, y]
+
+
+class Zone(BaseModel):
+    id: str
+    polygon: conlist(Point, min_length=3)  # Нормализованные координаты [[x, y], ...]
+    camera: Optional[str] = None  # None — зона действует для всех камер
+
+
+class Line(BaseModel):
+    id: str
+    p1: Point
+    p2: Point
+    camera: Optional[str] = None
+
+
+class AnalyticsConfig(BaseModel):
+    zones: List[Zone] = []
+    lines: List[Line] = []
+
+    @field_validator("zones", "lines")
+    @classmethod
+    def unique_ids(cls, items):
+        # Счетчики аналитики ведутся по id — одинаковые id слили бы статистику разных зон/линий
+        seen = set()
+        for item in items:
+            if item.id in seen:
+                raise ValueError(f"повторяющийся id: {item.id}")
+            seen.add(item.id)
+        return items
 
 
 # Хранилище оповещений (в реальной системе использовать БД)
 alerts = []
+alerts_json = []  # Оповещения, сериализованные один раз при создании (параллельно alerts)
 last_alerts_cleanup = time.time()
 
+# Кэш готовых ответов для опрашиваемых эндпоинтов; сбрасывается при каждой записи
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+BOOT_ID = uuid.uuid4().hex[:8]  # Чтобы ETag не совпал после перезапуска с обнуленной версией
+alerts_version = 0
+response_cache = {}  # (эндпоинт, параметры) -> (версия, ETag, тело)
+alerts_lock = Lock()
+
+
+def dumps_json(obj):
+    """Сериализация в байты: orjson, если установлен, иначе компактный json"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+@lru_cache(maxsize=4096)
+def format_datetime(second):
+    # Оповещения идут пачками в пределах одной секунды — строка форматируется один раз
+    return datetime.fromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def cached_json_response(request, key, build):
+    """
+    Ответ из кэша для текущей версии данных. Если ETag совпадает с If-None-Match,
+    возвращается 304 без тела.
+    """
+    with alerts_lock:
+        version = alerts_version
+        cached = response_cache.get(key)
+    if cached is None or cached[0] != version:
+        with alerts_lock:
+            body = build()
+            etag = f'"{BOOT_ID}-{version}-{"-".join(str(part) for part in key)}"'
+            cached = (version, etag, body)
+            response_cache[key] = cached
+    _, etag, body = cached
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# Параметры инкрементальной аналитики треков
+TRACK_TTL_SECONDS = float(os.environ.get("TRACK_TTL_SECONDS", "5"))  # Трек без обновлений считается ушедшим
+TRAJECTORY_MAX_POINTS = int(os.environ.get("TRAJECTORY_MAX_POINTS", "200"))
+ANALYTICS_CONFIG_PATH = os.environ.get("ANALYTICS_CONFIG_PATH")
+
+
+def point_in_polygon(x, y, polygon):
+    """Проверка попадания точки в многоугольник (ray casting)"""
+    inside = False
+    n = len(polygon)
+    j = n - 1
+    for i in range(n):
+        xi, yi = polygon[i][0], polygon[i][1]
+        xj, yj = polygon[j][0], polygon[j][1]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def side_of_line(p1, p2, x, y):
+    """Знак векторного произведения: с какой стороны линии p1->p2 лежит точка"""
+    return (p2[0] - p1[0]) * (y - p1[1]) - (p2[1] - p1[1]) * (x - p1[0])
+
+
+def segments_intersect(a1, a2, b1, b2):
+    d1 = side_of_line(b1, b2, a1[0], a1[1])
+    d2 = side_of_line(b1, b2, a2[0], a2[1])
+    d3 = side_of_line(a1, a2, b1[0], b1[1])
+    d4 = side_of_line(a1, a2, b2[0], b2[1])
+    return d1 * d2 < 0 and d3 * d4 < 0
+
+
+class TrackState:
+    def __init__(self, camera, track_id, timestamp, point, received_at):
+        self.camera = camera
+        self.track_id = track_id
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.received_at = received_at  # time.monotonic() приема последнего обновления (для TTL)
+        self.point = point
+        self.trajectory = deque(maxlen=TRAJECTORY_MAX_POINTS)
+        self.zones = {}  # zone_id -> время входа
+        self.dwell = {}  # zone_id -> накопленное время в зоне, сек
+
+
+class TrackAnalytics:
+    """
+    Инкрементальная аналитика по обновлениям треков: время пребывания в зонах,
+    пересечения линий и текущая заполненность по камерам и зонам.
+    Каждое оповещение обрабатывается за O(1) относительно числа накопленных
+    оповещений (линейно только по числу настроенных зон и линий).
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.config = AnalyticsConfig()
+        self.reset()
+
+    def reset(self):
+        # Треки упорядочены по времени приема последнего обновления — устаревшие снимаются с начала.
+        # Время оповещения задает отправитель (часы камеры), поэтому для TTL оно не используется
+        self.tracks = OrderedDict()
+        self.camera_occupancy = {}
+        self.zone_occupancy = {zone.id: 0 for zone in self.config.zones}
+        self.zone_dwell = {zone.id: {"total_seconds": 0.0, "visits": 0} for zone in self.config.zones}
+        self.line_counts = {line.id: {"forward": 0, "backward": 0} for line in self.config.lines}
+
+    def set_config(self, config):
+        with self.lock:
+            self.config = config
+            self.reset()
+
+    def _applies(self, item, camera):
+        return item.camera is None or item.camera == camera
+
+    def update(self, camera, track_id, bbox, timestamp):
+        # Опорная точка — середина нижней границы рамки (точка контакта с полом)
+        x = (bbox[0] + bbox[2]) / 2.0
+        y = bbox[3]
+        key = (camera, track_id)
+        received_at = time.monotonic()
+        with self.lock:
+            self._expire(received_at)
+            state = self.tracks.get(key)
+            if state is None:
+                state = TrackState(camera, track_id, timestamp, (x, y), received_at)
+                self.tracks[key] = state
+                self.camera_occupancy[camera] = self.camera_occupancy.get(camera, 0) + 1
+                prev_point = None
+                elapsed = 0.0
+            else:
+                state.received_at = received_at
+                self.tracks.move_to_end(key)
+                if timestamp < state.last_seen:
+                    return  # Устаревшее (переупорядоченное) обновление
+                prev_point = state.point
+                # Время в зоне считается по времени оповещений, а не по времени приема
+                elapsed = timestamp - state.last_seen
+                state.last_seen = timestamp
+                state.point = (x, y)
+            state.trajectory.append((timestamp, round(x, 4), round(y, 4)))
+
+            for zone in self.config.zones:
+                if not self._applies(zone, camera):
+                    continue
+                inside = point_in_polygon(x, y, zone.polygon)
+                was_inside = zone.id in state.zones
+                if was_inside:
+                    # Время между обновлениями засчитывается зоне, в которой трек был
+                    state.dwell[zone.id] = state.dwell.get(zone.id, 0.0) + elapsed
+                    self.zone_dwell[zone.id]["total_seconds"] += elapsed
+                if inside and not was_inside:
+                    state.zones[zone.id] = timestamp
+                    self.zone_occupancy[zone.id] += 1
+                    self.zone_dwell[zone.id]["visits"] += 1
+                elif was_inside and not inside:
+                    del state.zones[zone.id]
+                    self.zone_occupancy[zone.id] -= 1
+
+            if prev_point is not None:
+                for line in self.config.lines:
+                    if not self._applies(line, camera):
+                        continue
+                    if segments_intersect(prev_point, (x, y), line.p1, line.p2):
+                        direction = "forward" if side_of_line(line.p1, line.p2, x, y) > 0 else "backward"
+                        self.line_counts[line.id][direction] += 1
+
+    def _expire(self, now):
+        while self.tracks:
+            key, state = next(iter(self.tracks.items()))
+            if now - state.received_at <= TRACK_TTL_SECONDS:
+                break
+            self.tracks.popitem(last=False)
+            self.camera_occupancy[state.camera] -= 1
+            if self.camera_occupancy[state.camera] <= 0:
+                del self.camera_occupancy[state.camera]
+            for zone_id in state.zones:
+                self.zone_occupancy[zone_id] -= 1
+
+    def occupancy(self):
+        with self.lock:
+            self._expire(time.monotonic())
+            return {"cameras": dict(self.camera_occupancy), "zones": dict(self.zone_occupancy)}
+
+    def zones_summary(self):
+        with self.lock:
+            self._expire(time.monotonic())
+            result = {}
+            for zone_id, dwell in self.zone_dwell.items():
+                visits = dwell["visits"]
+                result[zone_id] = {
+                    "total_dwell_seconds": round(dwell["total_seconds"], 2),
+                    "visits": visits,
+                    "avg_dwell_seconds": round(dwell["total_seconds"] / visits, 2) if visits else 0.0,
+                    "current_occupancy": self.zone_occupancy.get(zone_id, 0),
+                }
+            return result
+
+    def lines_summary(self):
+        with self.lock:
+            return {line_id: dict(counts, total=counts["forward"] + counts["backward"])
+                    for line_id, counts in self.line_counts.items()}
+
+    def track_info(self, track_id, camera=None):
+        with self.lock:
+            for (cam, tid), state in self.tracks.items():
+                if tid == track_id and (camera is None or cam == camera):
+                    return {
+                        "camera": cam, "track_id": tid,
+                        "first_seen": state.first_seen, "last_seen": state.last_seen,
+                        "zones": list(state.zones),
+                        "dwell_seconds": {z: round(v, 2) for z, v in state.dwell.items()},
+                        "trajectory": list(state.trajectory),
+                    }
+            return None
+
+
+# Хранилище снимков треков
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "/app/snapshots" if os.path.exists("/app") else "snapshots")
+SNAPSHOT_CACHE_MAX_BYTES = int(os.environ.get("SNAPSHOT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+SNAPSHOT_MAX_BYTES = int(os.environ.get("SNAPSHOT_MAX_BYTES", str(2 * 1024 * 1024)))
+SNAPSHOT_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class SnapshotStore:
+    """
+    Дисковый кэш снимков с адресацией по содержимому: ключ — sha256 JPEG,
+    одинаковые снимки хранятся один раз. При превышении SNAPSHOT_CACHE_MAX_BYTES
+    вытесняются давно не запрашивавшиеся (LRU).
+    """
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.index = OrderedDict()  # snapshot_id -> размер, от давно использованных к недавним
+        self.total_bytes = 0
+        self.track_snapshots = OrderedDict()  # (камера, track_id) -> snapshot_id
+        self._load_existing()
+
+    def _path(self, snapshot_id):
+        return os.path.join(self.root, snapshot_id[:2], snapshot_id + ".jpg")
+
+    def _load_existing(self):
+        if not os.path.isdir(self.root):
+            return
+        found = []
+        for subdir in os.listdir(self.root):
+            subdir_path = os.path.join(self.root, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            for name in os.listdir(subdir_path):
+                snapshot_id = name[:-4]
+                if name.endswith(".jpg") and SNAPSHOT_ID_RE.match(snapshot_id):
+                    st = os.stat(os.path.join(subdir_path, name))
+                    found.append((st.st_atime, snapshot_id, st.st_size))
+        for _, snapshot_id, size in sorted(found):
+            self.index[snapshot_id] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.index:
+            snapshot_id, size = self.index.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(snapshot_id))
+            except OSError:
+                pass
+
+    def put(self, data, camera, track_id):
+        snapshot_id = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if snapshot_id in self.index:
+                self.index.move_to_end(snapshot_id)
+            else:
+                path = self._path(snapshot_id)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = path + ".part"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self.index[snapshot_id] = len(data)
+                self.total_bytes += len(data)
+                self._evict()
+            if track_id is not None:
+                key = (camera, track_id)
+                self.track_snapshots[key] = snapshot_id
+                self.track_snapshots.move_to_end(key)
+                while len(self.track_snapshots) > 10000:
+                    self.track_snapshots.popitem(last=False)
+        return snapshot_id
+
+    def get_path(self, snapshot_id):
+        with self.lock:
+            if snapshot_id not in self.index:
+                return None
+            self.index.move_to_end(snapshot_id)
+            return self._path(snapshot_id)
+
+    def for_track(self, track_id, camera=None):
+        with self.lock:
+            for (cam, tid), snapshot_id in reversed(self.track_snapshots.items()):
+                if tid == track_id and (camera is None or cam == camera):
+                    return snapshot_id
+            return None
+
+
+snapshot_store = SnapshotStore(SNAPSHOT_DIR, SNAPSHOT_CACHE_MAX_BYTES)
+
+
+track_analytics = TrackAnalytics()
+if ANALYTICS_CONFIG_PATH and os.path.exists(ANALYTICS_CONFIG_PATH):
+    with open(ANALYTICS_CONFIG_PATH) as f:
+        track_analytics.set_config(AnalyticsConfig(**json.load(f)))
+
 
 @app.get("/")
 def read_root():
@@ -43,33 +410,59 @@ def read_root():
 @app.post("/alerts")
 def create_alert(alert: Alert):
     """Создание нового оповещения"""
+    global alerts_version
     if alert.timestamp is None:
         alert.timestamp = time.time()
 
     # Добавляем дату и время для удобства просмотра на фронтенде
-    alert_dict = alert.dict()
-    alert_dict["datetime"] = datetime.fromtimestamp(alert.timestamp).strftime('%Y-%m-%d %H:%M:%S')
+    alert_dict = alert.model_dump()
+    alert_dict["datetime"] = format_datetime(int(alert.timestamp))
+    alert_json = dumps_json(alert_dict)
 
-    alerts.append(alert_dict)
-
-    # Очистка старых оповещений (оставляем только последние 100)
+    # Добавление, очистка и смена версии — одной секцией: кэш ответов не должен увидеть
+    # промежуточный список под той же версией
     global last_alerts_cleanup
-    if len(alerts) > 100 or time.time() - last_alerts_cleanup > 3600:
-        alerts[:] = alerts[-100:]
-        last_alerts_cleanup = time.time()
+    with alerts_lock:
+        alerts.append(alert_dict)
+        alerts_json.append(alert_json)
+        # Очистка старых оповещений (оставляем только последние 100)
+        if len(alerts) > 100 or time.time() - last_alerts_cleanup > 3600:
+            alerts[:] = alerts[-100:]
+            alerts_json[:] = alerts_json[-100:]
+            last_alerts_cleanup = time.time()
+        alerts_version += 1
+        alert_id = len(alerts)
+
+    if alert.track_id is not None and alert.bbox_normalized and len(alert.bbox_normalized) == 4:
+        track_analytics.update(alert.source_info or "default", alert.track_id,
+                               alert.bbox_normalized, alert.timestamp)
 
-    return {"status": "success", "id": len(alerts)}
+    return {"status": "success", "id": alert_id}
 
 
 @app.get("/alerts")
-def get_alerts(limit: int = 100):
+def get_alerts(request: Request, limit: int = 100):
     """Получение списка оповещений"""
-    return {"alerts": alerts[-limit:]}
+    # Хранится не больше 100 оповещений; ограничение также держит число ключей кэша конечным
+    limit = min(max(limit, 0), 100)
+    if not RESPONSE_CACHE_ENABLED:
+        return {"alerts": alerts[-limit:] if limit else []}
+    # Тело собирается из заранее сериализованных оповещений без повторного кодирования
+    return cached_json_response(
+        request, ("alerts", limit),
+        lambda: b'{"alerts":[' + b",".join(alerts_json[-limit:] if limit else []) + b"]}",
+    )
 
 
 @app.get("/stats")
-def get_stats():
+def get_stats(request: Request):
     """Получение статистики по трекам"""
+    if not RESPONSE_CACHE_ENABLED:
+        return compute_stats()
+    return cached_json_response(request, ("stats",), lambda: dumps_json(compute_stats()))
+
+
+def compute_stats():
     if not alerts:
         return {"tracks": 0, "alerts": 0}
 
@@ -86,6 +479,81 @@ def get_stats():
     }
 
 
+@app.post("/snapshots")
+async def upload_snapshot(request: Request, track_id: Optional[str] = None, camera: Optional[str] = None,
+                          confidence: Optional[float] = None):
+    """Прием JPEG-снимка трека (тело запроса — байты изображения)"""
+    data = await request.body()
+    if not data:
+        raise HTTPException(status_code=400, detail="Пустой снимок")
+    if len(data) > SNAPSHOT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Снимок слишком большой")
+    # Хеширование и запись на диск — в пуле потоков, чтобы не блокировать event loop
+    snapshot_id = await run_in_threadpool(snapshot_store.put, data, camera or "default", track_id)
+    return {"status": "success", "id": snapshot_id, "url": f"/snapshots/{snapshot_id}"}
+
+
+@app.get("/snapshots/{snapshot_id}")
+def get_snapshot(snapshot_id: str):
+    """Снимок по id (sha256); содержимое неизменно, поэтому кэшируется клиентом надолго"""
+    if not SNAPSHOT_ID_RE.match(snapshot_id):
+        raise HTTPException(status_code=400, detail="Некорректный id снимка")
+    path = snapshot_store.get_path(snapshot_id)
+    if path is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Снимок не найден")
+    return FileResponse(path, media_type="image/jpeg",
+                        headers={"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{snapshot_id}"'})
+
+
+@app.get("/tracks/{track_id}/snapshot")
+def get_track_snapshot(track_id: str, camera: Optional[str] = None):
+    """Лучший снимок трека"""
+    snapshot_id = snapshot_store.for_track(track_id, camera)
+    if snapshot_id is None:
+        raise HTTPException(status_code=404, detail="Снимок трека не найден")
+    return get_snapshot(snapshot_id)
+
+
+@app.get("/analytics/occupancy")
+def get_occupancy():
+    """Текущее количество треков по камерам и зонам"""
+    return track_analytics.occupancy()
+
+
+@app.get("/analytics/zones")
+def get_zone_stats():
+    """Время пребывания и посещения по зонам"""
+    return {"zones": track_analytics.zones_summary()}
+
+
+@app.get("/analytics/lines")
+def get_line_stats():
+    """Счетчики пересечения линий"""
+    return {"lines": track_analytics.lines_summary()}
+
+
+@app.get("/analytics/tracks/{track_id}")
+def get_track(track_id: int, camera: Optional[str] = None):
+    """Траектория и время пребывания в зонах для активного трека"""
+    info = track_analytics.track_info(track_id, camera)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Трек не найден или уже неактивен")
+    return info
+
+
+@app.get("/analytics/config")
+def get_analytics_config():
+    """Текущая конфигурация зон и линий"""
+    return track_analytics.config
+
+
+@app.put("/analytics/config")
+def set_analytics_config(config: AnalyticsConfig):
+    """Замена конфигурации зон и линий (накопленная аналитика сбрасывается)"""
+    track_analytics.set_config(config)
+    return {"status": "success", "zones": len(config.zones), "lines": len(config.lines)}
+
+
 @app.get("/stream-info")
 def get_stream_info():
     """Информация о видеопотоке"""
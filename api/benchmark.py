@@ -0,0 +1,92 @@
+# api/benchmark.py
+"""
+Замер пропускной способности опрашиваемых эндпоинтов API (GET /alerts, GET /stats)
+без сети: запросы подаются напрямую в ASGI-приложение, включая middleware.
+
+Сравниваются режимы:
+  - без кэша (прежний путь: dict -> JSON-кодировщик FastAPI на каждый запрос);
+  - с кэшем готовых ответов;
+  - с кэшем и If-None-Match (неизмененный опрос получает 304).
+
+Запуск из каталога api/:
+    python benchmark.py --requests 3000
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app"))
+import main  # noqa: E402
+
+
+async def call(path, query="", headers=None, method="GET", body=b""):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": query.encode(), "root_path": "",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 8000),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    response = {"status": None, "headers": {}, "body": b""}
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {k.decode(): v.decode() for k, v in message.get("headers", [])}
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    await main.app(scope, receive, send)
+    return response
+
+
+async def seed_alerts(count):
+    for i in range(count):
+        body = main.dumps_json({
+            "timestamp": time.time(), "track_id": i % 20,
+            "bbox_normalized": [0.1, 0.2, 0.3, 0.4], "confidence": 0.87,
+            "class_id": 0, "source_info": "camera_udp_0",
+        })
+        await call("/alerts", method="POST", body=body, headers={"Content-Type": "application/json"})
+
+
+async def measure(path, query, n, cache_enabled, conditional):
+    main.RESPONSE_CACHE_ENABLED = cache_enabled
+    headers = {}
+    if conditional:
+        first = await call(path, query)
+        headers["If-None-Match"] = first["headers"].get("etag", "")
+    start = time.perf_counter()
+    for _ in range(n):
+        response = await call(path, query, headers)
+    elapsed = time.perf_counter() - start
+    return n / elapsed, response["status"]
+
+
+async def run(n):
+    await seed_alerts(100)
+    modes = [
+        ("без кэша", False, False),
+        ("кэш", True, False),
+        ("кэш + If-None-Match", True, True),
+    ]
+    for path, query in (("/alerts", "limit=100"), ("/stats", "")):
+        baseline = None
+        for name, cache_enabled, conditional in modes:
+            rps, status = await measure(path, query, n, cache_enabled, conditional)
+            baseline = baseline or rps
+            print(f"GET {path:8s} {name:22s} {rps:9.0f} запр/с  (x{rps / baseline:.1f}, статус {status})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк эндпоинтов чтения API")
+    parser.add_argument("--requests", type=int, default=3000, help="Запросов на каждый режим")
+    args = parser.parse_args()
+    print(f"Сериализатор: {'orjson' if main.orjson is not None else 'json'}")
+    asyncio.run(run(args.requests))
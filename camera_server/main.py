@@ -4,6 +4,7 @@ import time
 import numpy as np
 import os
 import logging
+import struct
 import traceback
 
 # Настройка логирования
@@ -13,6 +14,18 @@ logging.basicConfig(level=numeric_level,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Заголовок кадра: magic, номер кадра, время захвата (unix, сек), длина id камеры; далее id камеры и JPEG
+FRAME_HEADER_MAGIC = b"VSF1"
+FRAME_HEADER = struct.Struct(">4sIdB")
+CAMERA_ID = os.environ.get('CAMERA_ID', socket.gethostname())
+
+
+def pack_frame(jpeg_bytes, seq, capture_ts):
+    """Добавляет к JPEG заголовок с номером кадра и временем захвата для трассировки задержек"""
+    camera_bytes = CAMERA_ID.encode("utf-8")[:255]
+    header = FRAME_HEADER.pack(FRAME_HEADER_MAGIC, seq & 0xFFFFFFFF, capture_ts, len(camera_bytes))
+    return header + camera_bytes + jpeg_bytes.tobytes()
+
 
 def get_analytics_host():
     """Получаем имя хоста analytics из переменной окружения или используем значение по умолчанию"""
@@ -95,6 +108,7 @@ def main():
     while True:
         try:
             ret, frame = cap.read()
+            capture_ts = time.time()
 
             if not ret:
                 if use_test_video:
@@ -124,7 +138,7 @@ def main():
 
             # Отправляем кадр на сервис аналитики
             try:
-                sock.sendto(buffer, (analytics_host, analytics_port))
+                sock.sendto(pack_frame(buffer, frame_count + 1, capture_ts), (analytics_host, analytics_port))
                 error_count = 0  # Сбрасываем счетчик ошибок при успешной отправке
             except socket.gaierror:
                 error_count += 1
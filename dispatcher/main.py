@@ -0,0 +1,238 @@
+# dispatcher/main.py
+"""
+UDP-диспетчер кадров: принимает датаграммы камер на публичном порту и
+распределяет их по пулу экземпляров аналитики консистентным хешированием
+по идентификатору камеры. Все кадры одной камеры попадают на один
+экземпляр (трекер сохраняет состояние), а при падении экземпляра
+переезжают только его камеры.
+
+Локальная проверка с двумя экземплярами аналитики:
+    UDP_PORT=5006 WEBSOCKET_PORT=8081 python analytics/main.py
+    UDP_PORT=5007 WEBSOCKET_PORT=8082 python analytics/main.py
+    WORKERS=localhost:5006:8081,localhost:5007:8082 python dispatcher/main.py
+"""
+import os
+import time
+import socket
+import struct
+import bisect
+import hashlib
+import logging
+from threading import Thread, Lock
+
+import requests
+import uvicorn
+from fastapi import FastAPI
+
+# Настройка логирования
+log_level = os.environ.get('LOG_LEVEL', 'INFO')
+numeric_level = getattr(logging, log_level.upper(), logging.INFO)
+logging.basicConfig(level=numeric_level,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Конфигурационные параметры ---
+UDP_PORT = int(os.getenv("UDP_PORT", "5005"))
+HTTP_PORT = int(os.getenv("HTTP_PORT", "8090"))
+# Список экземпляров аналитики: host:udp_port:http_port через запятую
+WORKERS = os.getenv("WORKERS", "localhost:5006:8081")
+VIRTUAL_NODES = int(os.getenv("VIRTUAL_NODES", "100"))
+HEALTH_INTERVAL = float(os.getenv("HEALTH_INTERVAL", "2.0"))
+HEALTH_TIMEOUT = float(os.getenv("HEALTH_TIMEOUT", "1.0"))
+HEALTH_FAILURES = int(os.getenv("HEALTH_FAILURES", "3"))  # Подряд неудачных проверок до исключения
+
+# Заголовок кадра (совпадает с analytics/main.py):
+# magic, номер кадра, время захвата (unix, сек), длина id камеры; далее id камеры и JPEG
+FRAME_HEADER_MAGIC = b"VSF1"
+FRAME_HEADER = struct.Struct(">4sIdB")
+MAX_DATAGRAM_SIZE = 65507  # Предел полезной нагрузки UDP поверх IPv4
+
+
+def parse_camera_id(data):
+    """Идентификатор камеры из заголовка кадра или None, если заголовка нет"""
+    if len(data) < FRAME_HEADER.size or not data.startswith(FRAME_HEADER_MAGIC):
+        return None
+    _, _, _, id_len = FRAME_HEADER.unpack_from(data)
+    return data[FRAME_HEADER.size:FRAME_HEADER.size + id_len].decode("utf-8", errors="replace")
+
+
+def add_frame_header(data, camera_id, seq=0, capture_ts=0.0):
+    """Добавление заголовка к «голому» JPEG, чтобы экземпляр аналитики знал исходную камеру"""
+    camera_bytes = camera_id.encode("utf-8")[:255]
+    return FRAME_HEADER.pack(FRAME_HEADER_MAGIC, seq, capture_ts, len(camera_bytes)) + camera_bytes + data
+
+
+def hash_key(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class Worker:
+    def __init__(self, spec):
+        host, udp_port, http_port = spec.strip().split(":")
+        self.name = f"{host}:{udp_port}"
+        self.address = (host, int(udp_port))
+        self.health_url = f"http://{host}:{http_port}/health"
+        self.healthy = True
+        self.failures = 0
+        self.datagrams = 0
+        self.bytes = 0
+        self.send_errors = 0
+        self.cameras = set()
+        self.processing_fps = None
+
+    def metrics(self):
+        return {
+            "healthy": self.healthy, "datagrams_forwarded": self.datagrams,
+            "bytes_forwarded": self.bytes, "send_errors": self.send_errors,
+            "cameras": sorted(self.cameras), "processing_fps": self.processing_fps,
+        }
+
+
+class HashRing:
+    """Консистентное хеширование с виртуальными узлами"""
+    def __init__(self, workers, virtual_nodes):
+        self.virtual_nodes = virtual_nodes
+        points = []
+        for worker in workers:
+            for i in range(virtual_nodes):
+                points.append((hash_key(f"{worker.name}#{i}"), worker))
+        points.sort(key=lambda p: p[0])
+        self.keys = [p[0] for p in points]
+        self.nodes = [p[1] for p in points]
+
+    def get(self, camera_id):
+        if not self.nodes:
+            return None
+        idx = bisect.bisect(self.keys, hash_key(camera_id)) % len(self.keys)
+        return self.nodes[idx]
+
+
+class Dispatcher:
+    def __init__(self, worker_specs):
+        self.workers = [Worker(spec) for spec in worker_specs.split(",") if spec.strip()]
+        self.lock = Lock()
+        self.ring = HashRing(self.workers, VIRTUAL_NODES)
+        self.assignments = {}  # camera_id -> Worker (кэш, сбрасывается при перестройке кольца)
+        self.dropped = 0
+        self.oversized = 0
+        self.rebalances = 0
+
+    def rebuild_ring(self):
+        healthy = [w for w in self.workers if w.healthy]
+        ring = HashRing(healthy, VIRTUAL_NODES)
+        with self.lock:
+            self.ring = ring
+            self.assignments = {}
+            for worker in self.workers:
+                worker.cameras = set()
+            self.rebalances += 1
+        logger.info(f"Кольцо перестроено. Доступные экземпляры: {[w.name for w in healthy] or 'нет'}")
+
+    def route(self, camera_id):
+        with self.lock:
+            worker = self.assignments.get(camera_id)
+            if worker is None:
+                worker = self.ring.get(camera_id)
+                if worker is not None:
+                    self.assignments[camera_id] = worker
+                    worker.cameras.add(camera_id)
+                    logger.info(f"Камера {camera_id} назначена на {worker.name}")
+            return worker
+
+    def health_loop(self):
+        while True:
+            changed = False
+            for worker in self.workers:
+                try:
+                    response = requests.get(worker.health_url, timeout=HEALTH_TIMEOUT)
+                    ok = response.status_code == 200
+                    if ok:
+                        worker.processing_fps = response.json().get("processing_fps")
+                except requests.exceptions.RequestException:
+                    ok = False
+                except ValueError:
+                    ok = True  # Экземпляр ответил, но не JSON — считаем живым
+
+                if ok:
+                    worker.failures = 0
+                    if not worker.healthy:
+                        logger.info(f"Экземпляр {worker.name} снова доступен")
+                        worker.healthy = True
+                        changed = True
+                else:
+                    worker.failures += 1
+                    if worker.healthy and worker.failures >= HEALTH_FAILURES:
+                        logger.warning(f"Экземпляр {worker.name} не отвечает ({worker.failures} проверок), исключаем")
+                        worker.healthy = False
+                        changed = True
+            if changed:
+                self.rebuild_ring()
+            time.sleep(HEALTH_INTERVAL)
+
+    def receive_loop(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind(("0.0.0.0", UDP_PORT))
+        out_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        logger.info(f"Диспетчер слушает UDP порт {UDP_PORT}, экземпляров: {len(self.workers)}")
+
+        while True:
+            try:
+                data, addr = sock.recvfrom(65535)
+                if not data:
+                    continue
+                camera_id = parse_camera_id(data)
+                if camera_id is None:
+                    camera_id = f"{addr[0]}:{addr[1]}"
+                    data = add_frame_header(data, camera_id)
+                    if len(data) > MAX_DATAGRAM_SIZE:
+                        # Заголовок не помещается: кадр у самого предела UDP, переслать его нельзя
+                        self.oversized += 1
+                        logger.warning(f"Кадр камеры {camera_id} с заголовком ({len(data)} байт) больше предела UDP "
+                                       f"({MAX_DATAGRAM_SIZE}). Снизьте качество JPEG или разрешение камеры.")
+                        continue
+
+                worker = self.route(camera_id)
+                if worker is None:
+                    self.dropped += 1
+                    continue
+                try:
+                    out_sock.sendto(data, worker.address)
+                    worker.datagrams += 1
+                    worker.bytes += len(data)
+                except OSError as e:
+                    worker.send_errors += 1
+                    logger.debug(f"Ошибка пересылки на {worker.name}: {e}")
+            except Exception as e:
+                logger.error(f"Ошибка в цикле приема UDP: {e}", exc_info=True)
+                time.sleep(0.1)
+
+
+dispatcher = Dispatcher(WORKERS)
+
+app = FastAPI(title="Vision UDP Dispatcher")
+
+
+@app.get("/health")
+def health_check():
+    healthy = sum(1 for w in dispatcher.workers if w.healthy)
+    return {"status": "ok" if healthy else "degraded", "healthy_workers": healthy,
+            "total_workers": len(dispatcher.workers)}
+
+
+@app.get("/workers")
+def get_workers():
+    """Нагрузка и состояние экземпляров аналитики"""
+    return {
+        "workers": {w.name: w.metrics() for w in dispatcher.workers},
+        "dropped_no_worker": dispatcher.dropped,
+        "dropped_oversized": dispatcher.oversized,
+        "rebalances": dispatcher.rebalances,
+    }
+
+
+if __name__ == "__main__":
+    Thread(target=dispatcher.health_loop, daemon=True).start()
+    Thread(target=uvicorn.run, args=(app,), kwargs={"host": "0.0.0.0", "port": HTTP_PORT, "log_level": "warning"},
+           daemon=True).start()
+    dispatcher.receive_loop()
@@ -0,0 +1,268 @@
+# load_generator.py
+"""
+Генератор синтетической нагрузки: N виртуальных камер шлют кадры на сервис
+аналитики (или диспетчер) для нагрузочного тестирования.
+
+Кадры берутся из видеофайла или каталога с изображениями и кодируются в JPEG
+один раз заранее. Каждая датаграмма несет заголовок VSF1 с id камеры,
+номером кадра и временем отправки; по журналу /frames/processed сервиса
+аналитики считаются доля доставленных кадров, потери и сквозная задержка.
+При нагрузке через диспетчер в --analytics-url перечисляются все экземпляры
+аналитики через запятую: журналы опрашиваются параллельно и объединяются.
+
+Пример:
+    python load_generator.py --cameras 8 --fps 15 --duration 60
+    python load_generator.py --source frames/ --cameras 32 --width 416 --height 416 --json report.json
+    python load_generator.py --port 5005 --analytics-url http://localhost:8081,http://localhost:8082
+
+Задержка считается как (время обработки в аналитике - время отправки), поэтому
+часы генератора и сервиса должны быть синхронизированы (проще всего — один хост).
+"""
+import os
+import sys
+import time
+import json
+import heapq
+import socket
+import struct
+import argparse
+from threading import Thread, Lock, Event
+
+import cv2
+import requests
+
+# Заголовок кадра (совпадает с analytics/main.py)
+FRAME_HEADER_MAGIC = b"VSF1"
+FRAME_HEADER = struct.Struct(">4sIdB")
+MAX_DATAGRAM_SIZE = 65507
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Синтетическая нагрузка из N виртуальных камер")
+    parser.add_argument("--source", default="test_video.mp4", help="Видеофайл или каталог с изображениями")
+    parser.add_argument("--host", default="localhost", help="Хост аналитики или диспетчера")
+    parser.add_argument("--port", type=int, default=5005, help="UDP порт")
+    parser.add_argument("--analytics-url", default="http://localhost:8080",
+                        help="HTTP адреса экземпляров аналитики через запятую для журнала обработанных кадров "
+                             "('' — не измерять)")
+    parser.add_argument("--cameras", type=int, default=4, help="Число виртуальных камер")
+    parser.add_argument("--fps", type=float, default=20.0, help="FPS каждой камеры")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--quality", type=int, default=80, help="Качество JPEG")
+    parser.add_argument("--max-frames", type=int, default=300, help="Максимум кадров, кодируемых заранее")
+    parser.add_argument("--duration", type=float, default=30.0, help="Длительность теста, сек")
+    parser.add_argument("--report-interval", type=float, default=5.0)
+    parser.add_argument("--grace", type=float, default=3.0, help="Ожидание «долетающих» кадров после окончания, сек")
+    parser.add_argument("--json", dest="json_path", help="Сохранить итоговый отчет в JSON")
+    return parser.parse_args()
+
+
+def load_frames(source, width, height, quality, max_frames):
+    """Чтение и однократное кодирование кадров источника"""
+    images = []
+    if os.path.isdir(source):
+        names = sorted(n for n in os.listdir(source) if n.lower().endswith(IMAGE_EXTENSIONS))
+        for name in names[:max_frames]:
+            img = cv2.imread(os.path.join(source, name))
+            if img is not None:
+                images.append(img)
+    else:
+        cap = cv2.VideoCapture(source)
+        while len(images) < max_frames:
+            ret, img = cap.read()
+            if not ret:
+                break
+            images.append(img)
+        cap.release()
+
+    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+    frames = []
+    skipped = 0
+    for img in images:
+        img = cv2.resize(img, (width, height))
+        result, buffer = cv2.imencode('.jpg', img, encode_param)
+        if not result:
+            continue
+        data = buffer.tobytes()
+        if len(data) + FRAME_HEADER.size + 255 > MAX_DATAGRAM_SIZE:
+            skipped += 1
+            continue
+        frames.append(data)
+    if skipped:
+        print(f"[WARNING] Пропущено {skipped} кадров больше лимита UDP. Снизьте --quality или разрешение.")
+    return frames
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+class LoadStats:
+    def __init__(self, camera_ids):
+        self.lock = Lock()
+        self.sent = {cid: 0 for cid in camera_ids}
+        self.send_errors = 0
+        self.delivered = {cid: set() for cid in camera_ids}
+        self.latencies_ms = []
+        self.interval_latencies_ms = []
+
+    def record_processed(self, record):
+        camera = record["camera"]
+        with self.lock:
+            if camera not in self.delivered or record["capture_ts"] is None:
+                return
+            if record["seq"] in self.delivered[camera]:
+                return
+            self.delivered[camera].add(record["seq"])
+            latency = (record["processed_at"] - record["capture_ts"]) * 1000.0
+            self.latencies_ms.append(latency)
+            self.interval_latencies_ms.append(latency)
+
+    def summary(self, elapsed, latencies=None):
+        latencies = self.latencies_ms if latencies is None else latencies
+        sent = sum(self.sent.values())
+        delivered = sum(len(s) for s in self.delivered.values())
+        return {
+            "elapsed_seconds": round(elapsed, 2),
+            "frames_sent": sent,
+            "frames_delivered": delivered,
+            "send_errors": self.send_errors,
+            "send_fps": round(sent / elapsed, 2) if elapsed > 0 else 0.0,
+            "delivered_fps": round(delivered / elapsed, 2) if elapsed > 0 else 0.0,
+            "delivery_rate": round(delivered / sent, 4) if sent else 0.0,
+            "drop_rate": round(1.0 - delivered / sent, 4) if sent else 0.0,
+            "latency_ms": {
+                "p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99), "max": max(latencies) if latencies else None,
+            },
+        }
+
+
+def sender_loop(frames, camera_ids, fps, address, duration, stats, stop_event):
+    """Отправка кадров всех камер из одного цикла по расписанию (heap по времени следующего кадра)"""
+    socks = {cid: socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for cid in camera_ids}
+    interval = 1.0 / fps
+    start = time.time()
+    # Камеры сдвинуты по фазе, чтобы не отправлять все кадры одновременно
+    schedule = [(start + i * interval / len(camera_ids), i, cid) for i, cid in enumerate(camera_ids)]
+    heapq.heapify(schedule)
+    seq = {cid: 0 for cid in camera_ids}
+    camera_bytes = {cid: cid.encode("utf-8") for cid in camera_ids}
+
+    while schedule and not stop_event.is_set():
+        next_time, idx, cid = heapq.heappop(schedule)
+        if next_time - start > duration:
+            break
+        delay = next_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        seq[cid] += 1
+        frame = frames[(seq[cid] + idx) % len(frames)]
+        header = FRAME_HEADER.pack(FRAME_HEADER_MAGIC, seq[cid], time.time(), len(camera_bytes[cid]))
+        try:
+            socks[cid].sendto(header + camera_bytes[cid] + frame, address)
+            with stats.lock:
+                stats.sent[cid] += 1
+        except OSError:
+            with stats.lock:
+                stats.send_errors += 1
+        heapq.heappush(schedule, (next_time + interval, idx, cid))
+
+    for sock in socks.values():
+        sock.close()
+
+
+def poll_processed(analytics_url, stats, stop_event):
+    """Чтение журнала обработанных кадров одного экземпляра аналитики"""
+    last_id = None
+    while not stop_event.is_set():
+        try:
+            if last_id is None:
+                # Пропускаем записи, сделанные до начала теста: after=-1 возвращает только id последней записи
+                response = requests.get(f"{analytics_url}/frames/processed", params={"after": -1}, timeout=2.0)
+                last_id = response.json()["last_id"]
+                continue
+            response = requests.get(f"{analytics_url}/frames/processed", params={"after": last_id}, timeout=2.0)
+            payload = response.json()
+            for record in payload["frames"]:
+                stats.record_processed(record)
+            last_id = payload["last_id"]
+            if len(payload["frames"]) < 5000:
+                stop_event.wait(0.5)
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            print(f"[WARNING] Не удалось получить журнал аналитики {analytics_url}: {e}")
+            stop_event.wait(1.0)
+
+
+def main():
+    args = parse_args()
+    frames = load_frames(args.source, args.width, args.height, args.quality, args.max_frames)
+    if not frames:
+        print(f"[ERROR] Не удалось получить кадры из {args.source}")
+        sys.exit(1)
+    avg_size = sum(len(f) for f in frames) / len(frames)
+    print(f"[INFO] Подготовлено {len(frames)} кадров {args.width}x{args.height}, средний размер {avg_size / 1024:.1f} КБ")
+    print(f"[INFO] {args.cameras} камер x {args.fps} FPS -> {args.host}:{args.port} "
+          f"(~{args.cameras * args.fps * avg_size * 8 / 1e6:.1f} Мбит/с)")
+
+    camera_ids = [f"virtual-{i}" for i in range(args.cameras)]
+    stats = LoadStats(camera_ids)
+    stop_sending = Event()
+    stop_polling = Event()
+
+    sender = Thread(target=sender_loop, args=(frames, camera_ids, args.fps, (args.host, args.port),
+                                              args.duration, stats, stop_sending), daemon=True)
+    # По потоку на экземпляр аналитики; кадры одной камеры дедуплицируются в LoadStats
+    analytics_urls = [url.strip().rstrip("/") for url in args.analytics_url.split(",") if url.strip()]
+    pollers = [Thread(target=poll_processed, args=(url, stats, stop_polling), daemon=True) for url in analytics_urls]
+    for poller in pollers:
+        poller.start()
+    if pollers:
+        time.sleep(0.5)
+
+    start = time.time()
+    sender.start()
+    try:
+        while sender.is_alive():
+            sender.join(timeout=args.report_interval)
+            with stats.lock:
+                interval_latencies, stats.interval_latencies_ms = stats.interval_latencies_ms, []
+                report = stats.summary(time.time() - start, interval_latencies)
+            lat = report["latency_ms"]
+            print(f"[INFO] {report['elapsed_seconds']:.0f}s: отправлено {report['send_fps']} FPS, "
+                  f"обработано {report['delivered_fps']} FPS, потери {report['drop_rate'] * 100:.1f}%, "
+                  f"задержка p50/p95 {lat['p50'] or 0:.0f}/{lat['p95'] or 0:.0f} мс")
+    except KeyboardInterrupt:
+        print("\n[INFO] Получен сигнал завершения (Ctrl+C).")
+        stop_sending.set()
+        sender.join()
+
+    elapsed = time.time() - start
+    if pollers:
+        time.sleep(args.grace)
+        stop_polling.set()
+        for poller in pollers:
+            poller.join()
+
+    with stats.lock:
+        report = stats.summary(elapsed)
+    report["config"] = {k: v for k, v in vars(args).items() if k != "json_path"}
+    report["per_camera"] = {
+        cid: {"sent": stats.sent[cid], "delivered": len(stats.delivered[cid])} for cid in camera_ids
+    }
+    print(json.dumps({k: v for k, v in report.items() if k != "per_camera"}, indent=2, ensure_ascii=False))
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"[INFO] Отчет сохранен в {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 # send_from_camera.py
 import cv2
 import socket
+import struct
 import time
 import sys
 
@@ -15,8 +16,14 @@ SEND_INTERVAL = 0.10
 JPEG_QUALITY = 75
 # Индекс камеры. 0 - обычно встроенная, 1, 2... - внешние.
 CAMERA_INDEX = 0
+# Идентификатор камеры в заголовке кадра
+CAMERA_ID = f"local_camera_{CAMERA_INDEX}"
 # --- Конец настроек ---
 
+# Заголовок кадра: magic, номер кадра, время захвата (unix, сек), длина id камеры; далее id камеры и JPEG
+FRAME_HEADER_MAGIC = b"VSF1"
+FRAME_HEADER = struct.Struct(">4sIdB")
+
 
 def main():
     # Инициализация камеры
@@ -53,6 +60,7 @@ def main():
         while True:
             # Захват кадра с камеры
             ret, frame = cap.read()
+            capture_ts = time.time()
             if not ret or frame is None:
                 print("[WARNING] Не удалось получить кадр с камеры, пропуск...")
                 time.sleep(0.1) # Пауза перед следующей попыткой
@@ -68,12 +76,15 @@ def main():
 
             # Отправка данных по UDP
             try:
-                # Проверяем размер буфера (UDP имеет ограничение ~64KB, но лучше меньше)
-                if len(buffer) > 60000:
-                     print(f"[WARNING] Размер кадра ({len(buffer)} байт) слишком большой для UDP. Попробуйте снизить качество JPEG или разрешение камеры.")
+                camera_bytes = CAMERA_ID.encode("utf-8")
+                header = FRAME_HEADER.pack(FRAME_HEADER_MAGIC, (frame_count + 1) & 0xFFFFFFFF, capture_ts, len(camera_bytes))
+                datagram = header + camera_bytes + buffer.tobytes()
+                # Проверяем размер датаграммы вместе с заголовком (UDP имеет ограничение ~64KB, но лучше меньше)
+                if len(datagram) > 60000:
+                     print(f"[WARNING] Размер кадра ({len(datagram)} байт) слишком большой для UDP. Попробуйте снизить качество JPEG или разрешение камеры.")
                      # Можно пропустить отправку или попытаться отправить
                      # continue
-                sock.sendto(buffer, (UDP_IP, UDP_PORT))
+                sock.sendto(datagram, (UDP_IP, UDP_PORT))
                 frame_count += 1
                 # print(f"Sent frame {frame_count}, size: {len(buffer)} bytes") # Для отладки
             except socket.error as e: